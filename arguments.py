@@ -1,6 +1,7 @@
 import argparse
 import os
 from dotenv import load_dotenv
+from embeddings import MODEL_DIMENSIONS, SHORTENABLE_MODELS
 
 def parse_args():
     parser = argparse.ArgumentParser(description='File embedding/vectorization tool.')
@@ -24,15 +25,229 @@ def parse_args():
     parser.add_argument('-t', '--token_count', action='store_true', required=False,
                         help='It only calculates the total number of tokens and the price.')
 
+    parser.add_argument('-s', '--estimate', action='store_true', required=False,
+                        help='Fast token and price estimate tokenizing the source files directly - no conversion, no database.')
+
+    parser.add_argument('--estimate_file', type=str, default='token_estimate.json', required=False,
+                        help='JSON report of the estimate, relative paths are placed in out_directory.')
+
+    parser.add_argument('--sample_units', type=int, default=50, required=False,
+                        help='Files with more pages (PDF) or 64 kB blocks (text) are sampled and extrapolated (0 = never sample).')
+
+    parser.add_argument('-n', '--incremental', action='store_true', required=False,
+                        help='Only process new or changed files (tracked in a manifest in out_directory) and replace their rows.')
+
+    parser.add_argument('-w', '--office_workers', type=int, default=4, required=False,
+                        help='Number of parallel LibreOffice workers converting office documents (default 4).')
+
+    parser.add_argument('--office_timeout', type=int, default=300, required=False,
+                        help='Seconds after which a hung LibreOffice conversion is killed and its worker restarted.')
+
+    parser.add_argument('-e', '--extract_workers', type=int, default=os.cpu_count(), required=False,
+                        help='Number of processes extracting text from PDFs, large PDFs are split into page ranges (default: CPU count).')
+
+    parser.add_argument('-p', '--parallel_requests', type=int, default=4, required=False,
+                        help='Number of embedding requests kept in flight at once (default 4).')
+
+    parser.add_argument('-b', '--batch_size', type=int, default=2048, required=False,
+                        help='Maximum number of chunks sent in one embedding request (1 - 2048, default 2048).')
+
+    parser.add_argument('--rpm', type=int, default=0, required=False,
+                        help='Embedding requests per minute limit of your OpenAI tier (0 = unlimited).')
+
+    parser.add_argument('--tpm', type=int, default=0, required=False,
+                        help='Embedding tokens per minute limit of your OpenAI tier (0 = unlimited).')
+
+    parser.add_argument('--cache_file', type=str, default='.embedding_cache.sqlite', required=False,
+                        help='SQLite file caching embeddings between runs (empty string disables the cache).')
+
+    parser.add_argument('--cache_size_mb', type=int, default=1024, required=False,
+                        help='Maximum size of the embedding cache in MB, least recently used vectors are evicted.')
+
+    parser.add_argument('--dimensions', type=int, default=None, required=False,
+                        help='Shortened embeddings of the text-embedding-3 models, e.g. 256, 512 or 1024 (default: full size).')
+
+    parser.add_argument('--halfvec', action='store_true', required=False,
+                        help='Store the embeddings as halfvec (float16) - half the storage, indexable up to 4000 dimensions.')
+
+    parser.add_argument('--binary_column', action='store_true', required=False,
+                        help='Add a binary quantized copy of the embedding for a Hamming distance pre-filter with re-ranking.')
+
+    parser.add_argument('--metrics_file', type=str, default='run_metrics.json', required=False,
+                        help='JSON report of stage timings, throughput, API latencies, retries and peak RSS (in the output directory).')
+
+    parser.add_argument('--prometheus_file', type=str, default=None, required=False,
+                        help='Also write the run metrics in Prometheus text format to this file (in the output directory).')
+
+    parser.add_argument('--profile', action='store_true', required=False,
+                        help='Run the stages under cProfile and write profile_<stage>.prof files to the output directory.')
+
+    parser.add_argument('--index_type', type=str, default='auto', required=False,
+                        choices=['auto', 'hnsw', 'ivfflat', 'none'],
+                        help='Vector index built after storing (auto = chosen by row count and dimension).')
+
+    parser.add_argument('--rebuild_index', action='store_true', required=False,
+                        help='Rebuild the vector index even if a valid index of the same type exists and the table has not doubled since its build.')
+
+    parser.add_argument('--index_memory_mb', type=int, default=4096, required=False,
+                        help='Upper limit of maintenance_work_mem in MB for the index build.')
+
+    parser.add_argument('--index_workers', type=int, default=4, required=False,
+                        help='max_parallel_maintenance_workers for the index build.')
+
+    parser.add_argument('-r', '--resume', action='store_true', required=False,
+                        help='Continue an interrupted run from its journal in the output directory without re-embedding stored chunks.')
+
+    parser.add_argument('--max_retries', type=int, default=6, required=False,
+                        help='Retries of a failed embedding request or database write, with exponential backoff and jitter.')
+
+    parser.add_argument('--dedup_threshold', type=float, default=None, required=False,
+                        help='Turn on deduplication: chunks whose estimated shingle similarity reaches this value are not embedded again (1.0 = exact duplicates only; default off).')
+
+    parser.add_argument('--skip_duplicates', action='store_true', required=False,
+                        help='Do not store duplicate chunks at all instead of storing them with the vector of the first occurrence.')
+
+    parser.add_argument('--distributed', type=str, default=None, required=False, choices=['coordinator', 'worker'],
+                        help='Spread the input files over several machines through a jobs table in the database: one coordinator, any number of workers.')
+
+    parser.add_argument('--claim_files', type=int, default=4, required=False,
+                        help='Files a worker claims and stores together.')
+
+    parser.add_argument('--heartbeat_seconds', type=int, default=30, required=False,
+                        help='Interval of the heartbeats of a worker for its claimed jobs.')
+
+    parser.add_argument('--stale_seconds', type=int, default=300, required=False,
+                        help='Jobs without a heartbeat for this long are given to another worker.')
+
+    parser.add_argument('--max_attempts', type=int, default=3, required=False,
+                        help='Attempts of a job before it is marked as failed.')
+
+    parser.add_argument('--worker_id', type=str, default=None, required=False,
+                        help='Name of the worker in the jobs table (default: <hostname>-<pid>).')
 
     args = parser.parse_args()
     limited_int(args.chunk_size, 50, 8000, 'chunk_size')
     limited_int(args.overlapping_size, 0, 40, 'overlapping_size')
+    limited_int(args.office_workers, 1, 64, 'office_workers')
+    limited_int(args.extract_workers, 1, 256, 'extract_workers')
+    limited_int(args.parallel_requests, 1, 64, 'parallel_requests')
+    limited_int(args.batch_size, 1, 2048, 'batch_size')
+    limited_int(args.index_memory_mb, 64, 1024 * 1024, 'index_memory_mb')
+    limited_int(args.index_workers, 0, 64, 'index_workers')
+    limited_int(args.max_retries, 0, 100, 'max_retries')
+    if args.dedup_threshold is not None and not 0 < args.dedup_threshold <= 1:
+        parser.error("--dedup_threshold must be above 0 and at most 1")
+    if args.skip_duplicates and args.dedup_threshold is None:
+        parser.error("--skip_duplicates requires --dedup_threshold")
+    limited_int(args.claim_files, 1, 1000, 'claim_files')
+    limited_int(args.heartbeat_seconds, 1, 3600, 'heartbeat_seconds')
+    limited_int(args.max_attempts, 1, 100, 'max_attempts')
+    if args.stale_seconds < 2 * args.heartbeat_seconds:
+        parser.error("--stale_seconds must be at least twice --heartbeat_seconds")
+    if args.distributed and (args.incremental or args.resume or args.token_count or args.estimate):
+        parser.error("--distributed runs cannot be combined with -n, --resume, -t or -s; the jobs table keeps the progress")
+    if args.resume and args.incremental:
+        parser.error("--resume continues a full run; an incremental run is committed at once and simply repeated")
+    if args.dimensions is not None:
+        if args.embedding_model not in SHORTENABLE_MODELS:
+            parser.error(f"{args.embedding_model} does not support --dimensions")
+        limited_int(args.dimensions, 1, MODEL_DIMENSIONS[args.embedding_model], 'dimensions')
     print('Command line parameters:')
     for key, value in vars(args).items():
         print(f"{key}: {value}")
     return args
 
+def parse_cluster_args():
+    parser = argparse.ArgumentParser(description='Clustering of the stored embeddings.')
+
+    parser.add_argument('mode', nargs='?', default='full', choices=['full', 'fit', 'assign'],
+                        help='full = KMeans over the whole table in memory, fit = streamed mini-batch k-means with stored centroids, '
+                             'assign = label only rows without cluster_id against the stored centroids (default full).')
+
+    parser.add_argument('-n', '--n_clusters', type=int, default=25, required=False,
+                        help='Number of clusters (default 25).')
+
+    parser.add_argument('--passes', type=int, default=2, required=False,
+                        help='Number of streamed passes over the table in fit mode (default 2).')
+
+    parser.add_argument('--drift_threshold', type=float, default=1.25, required=False,
+                        help='Assign mode refits when new rows are this many times further from their centers than at fit time (default 1.25).')
+
+    parser.add_argument('--metrics_file', type=str, default=None, required=False,
+                        help='Write the timings of the clustering stages as JSON to this file.')
+
+    parser.add_argument('--mmap_file', type=str, default=None, required=False,
+                        help='Load the embeddings into a memory mapped .npy file instead of RAM (tables bigger than memory).')
+
+    args = parser.parse_args()
+    limited_int(args.n_clusters, 2, 10000, 'n_clusters')
+    return args
+
+def parse_search_args():
+    parser = argparse.ArgumentParser(description='HTTP similarity search over the stored chunks.')
+
+    parser.add_argument('-m', '--embedding_model', required=True,
+                        choices=['text-embedding-3-small', 'text-embedding-3-large', 'text-embedding-ada-002'],
+                        help='Embedding model the table was created with.')
+
+    parser.add_argument('--host', type=str, default='127.0.0.1', required=False,
+                        help='Address to listen on (default 127.0.0.1).')
+
+    parser.add_argument('--port', type=int, default=8000, required=False,
+                        help='Port to listen on (default 8000).')
+
+    parser.add_argument('--pool_size', type=int, default=8, required=False,
+                        help='Maximum number of pooled database connections (default 8).')
+
+    parser.add_argument('--cache_entries', type=int, default=4096, required=False,
+                        help='Number of query embeddings kept in the LRU cache (default 4096).')
+
+    parser.add_argument('--probes', type=int, default=None, required=False,
+                        help='Default ivfflat.probes, requests may override it (default: server setting).')
+
+    parser.add_argument('--ef_search', type=int, default=None, required=False,
+                        help='Default hnsw.ef_search, requests may override it (default: server setting).')
+
+    args = parser.parse_args()
+    limited_int(args.pool_size, 1, 256, 'pool_size')
+    return args
+
+def parse_export_args():
+    parser = argparse.ArgumentParser(description='Export of the stored embeddings to a memory mapped index for offline search.')
+
+    parser.add_argument('mode', nargs='?', default='export', choices=['export', 'search'],
+                        help='export = write the index from the database, search = query an exported index (default export).')
+
+    parser.add_argument('-o', '--index_directory', type=str, required=True,
+                        help='Directory of the exported index.')
+
+    parser.add_argument('--dtype', type=str, default='float16', choices=['float16', 'int8'], required=False,
+                        help='Storage type of the vectors - float16 (half of float32) or int8 (a quarter) (default float16).')
+
+    parser.add_argument('--ivf_lists', type=int, default=0, required=False,
+                        help='Number of IVF lists of the coarse quantizer, 0 = exhaustive search, -1 = chosen by row count (default 0).')
+
+    parser.add_argument('--with_text', action='store_true', required=False,
+                        help='Store the chunk text in the metadata file as well.')
+
+    parser.add_argument('-m', '--embedding_model', default='text-embedding-3-small', required=False,
+                        choices=['text-embedding-3-small', 'text-embedding-3-large', 'text-embedding-ada-002'],
+                        help='Embedding model for the query in search mode.')
+
+    parser.add_argument('-q', '--query', type=str, default='', required=False,
+                        help='Query text in search mode.')
+
+    parser.add_argument('-k', type=int, default=10, required=False,
+                        help='Number of results in search mode (default 10).')
+
+    parser.add_argument('--nprobe', type=int, default=8, required=False,
+                        help='Number of IVF lists scanned per query in search mode (default 8).')
+
+    args = parser.parse_args()
+    if args.mode == 'search' and not args.query:
+        parser.error('search mode needs --query')
+    return args
+
 def get_env():
     load_dotenv()
     env_dict = {
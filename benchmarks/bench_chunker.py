@@ -0,0 +1,107 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tiktoken
+from pdf_2_text import split_text_into_chunks
+
+WORDS = ["the", "vector", "database", "stores", "chunks", "of", "text", "with", "embeddings", "page",
+         "Příliš", "žluťoučký", "kůň", "úpěl", "ďábelské", "ódy", "42", "3.14", "e-mail:", "http://example.com/a?b=c"]
+
+
+def legacy_split_text_into_chunks(pages, chunk_size, overlap, model_name, min_chunk_size=3):
+    # The chunker before the boundary index - kept here as the reference for equality and timing
+    result = {}
+
+    encoding = tiktoken.encoding_for_model(model_name)
+    all_tokens = [encoding.encode(page_text) for page_text in pages]
+
+    page_num = 1
+    chunk_num = 1
+    token_idx = 0
+
+    while page_num <= len(all_tokens):
+        tokens = all_tokens[page_num - 1]
+
+        while token_idx < len(tokens):
+            end_idx = token_idx + chunk_size
+
+            if end_idx > len(tokens) and page_num < len(all_tokens):
+                next_tokens_needed = end_idx - len(tokens)
+                tokens += all_tokens[page_num][:next_tokens_needed]
+                all_tokens[page_num] = all_tokens[page_num][next_tokens_needed:]
+
+            chunk_tokens = tokens[token_idx:end_idx]
+            chunk_text = encoding.decode(chunk_tokens)
+
+            while end_idx < len(tokens) and not chunk_text.endswith((' ', '\n')):
+                chunk_tokens.append(tokens[end_idx])
+                end_idx += 1
+                chunk_text = encoding.decode(chunk_tokens)
+
+            while token_idx > 0 and not encoding.decode([tokens[token_idx]]).startswith((' ', '\n')):
+                token_idx -= 1
+                chunk_tokens = tokens[token_idx:end_idx]
+                chunk_text = encoding.decode(chunk_tokens)
+
+            chunk_key = f"{page_num}_{chunk_num}"
+            result[chunk_key] = {
+                "text": chunk_text.strip(),
+                "length": len(chunk_tokens)
+            }
+
+            token_idx = end_idx - overlap
+            chunk_num += 1
+
+        page_num += 1
+        chunk_num = 1
+        token_idx = 0
+
+    return result
+
+
+def synthetic_pages(n_pages, words_per_page, seed=1):
+    # Mostly prose, with some long runs without whitespace (tables, base64) that stress the boundary search
+    rnd = random.Random(seed)
+    pages = []
+    for _ in range(n_pages):
+        words = []
+        for _ in range(words_per_page):
+            if rnd.random() < 0.002:
+                words.append("".join(rnd.choice("abcdefXYZ0123456789+/") for _ in range(rnd.randint(50, 400))))
+            else:
+                words.append(rnd.choice(WORDS))
+            if rnd.random() < 0.08:
+                words.append("\n")
+        pages.append(" ".join(words))
+    return pages
+
+
+def timed(chunker, pages, chunk_size, overlap, model_name):
+    start = time.perf_counter()
+    result = chunker(list(pages), chunk_size, overlap, model_name)
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compares the legacy and the boundary index chunker.')
+    parser.add_argument('-m', '--embedding_model', default='text-embedding-3-small')
+    parser.add_argument('--pages', type=int, default=40)
+    parser.add_argument('--words_per_page', type=int, default=2000)
+    parser.add_argument('-v', '--overlapping_size', type=int, default=20)
+    parser.add_argument('--chunk_sizes', type=str, default='100,300,800,2000,4000,8000')
+    args = parser.parse_args()
+
+    pages = synthetic_pages(args.pages, args.words_per_page)
+    split_text_into_chunks(pages[:1], 100, 0, args.embedding_model)  # load the encoding outside the timing
+    print(f"{'chunk_size':>10} {'chunks':>8} {'legacy [s]':>11} {'new [s]':>9} {'speedup':>8}")
+    for chunk_size in [int(size) for size in args.chunk_sizes.split(',')]:
+        legacy, legacy_time = timed(legacy_split_text_into_chunks, pages, chunk_size, args.overlapping_size, args.embedding_model)
+        new, new_time = timed(split_text_into_chunks, pages, chunk_size, args.overlapping_size, args.embedding_model)
+        if legacy != new:
+            raise SystemExit(f"Chunker output differs for chunk_size {chunk_size}")
+        print(f"{chunk_size:>10} {len(new):>8} {legacy_time:>11.3f} {new_time:>9.3f} {legacy_time / new_time:>7.1f}x")
@@ -0,0 +1,121 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import psycopg2
+
+from arguments import get_env
+from bench_chunker import synthetic_pages
+from embedding_stub import StubClient, stub_embedding
+from embeddings import MODEL_DIMENSIONS
+from search import SearchEngine
+from store_2_db import COPY_BATCH_ROWS, copy_rows, normalize_text, setup_database_and_table
+from vector_index import build_index, vector_types
+
+
+def fill_table(env_dict, rows, dim, vector_type="vector", chunk_words=120, seed=1):
+    # Synthetic chunks embedded by the offline stub, loaded with the same binary COPY as the ingestion
+    copy_type = vector_types[vector_type]["copy_type"]
+    conn = psycopg2.connect(dbname=env_dict['DB_NAME'], user=env_dict['DB_USER'], password=env_dict['DB_PASSWORD'],
+                            host=env_dict['DB_HOST'], port=env_dict['DB_PORT'])
+    table_name = env_dict['DB_TABLE_NAME']
+    with conn.cursor() as cursor:
+        cursor.execute(f"SELECT count(*) FROM {table_name};")
+        if cursor.fetchone()[0] >= rows:
+            conn.close()
+            return
+        cursor.execute(f"TRUNCATE {table_name};")
+    words = " ".join(synthetic_pages(max(rows * chunk_words // 2000, 1) + 1, 2000, seed)).split()
+    rnd = random.Random(seed)
+    batch = []
+    for i in range(rows):
+        start = rnd.randrange(max(len(words) - chunk_words, 1))
+        text = normalize_text(" ".join(words[start:start + chunk_words]))
+        batch.append((f"bench_{i // 100}.pdf", i % 100 + 1, 1, text, stub_embedding(text, dim)))
+        if len(batch) >= COPY_BATCH_ROWS:
+            copy_rows(conn, table_name, batch, True, copy_type)
+            batch = []
+            print(f"\rLoaded {i + 1} rows", end="", flush=True)
+    if batch:
+        copy_rows(conn, table_name, batch, True, copy_type)
+    print()
+    conn.close()
+
+
+def query_texts(engine, n_queries, seed=2):
+    # Random spans of stored chunks - close to, but not the same as, the indexed text
+    rnd = random.Random(seed)
+    with engine.connection() as cursor:
+        cursor.execute(f"SELECT text_chunk FROM {engine.table_name} ORDER BY random() LIMIT %s;", (n_queries,))
+        chunks = [row[0].split() for row in cursor.fetchall()]
+    queries = []
+    for words in chunks:
+        start = rnd.randrange(max(len(words) - 12, 1))
+        queries.append(" ".join(words[start:start + rnd.randint(4, 12)]))
+    return queries
+
+
+def run(engine, queries, k, **options):
+    latencies = []
+    results = []
+    for query in queries:
+        start = time.perf_counter()
+        results.append([row["id"] for row in engine.search(query, k, **options)])
+        latencies.append((time.perf_counter() - start) * 1000)
+    return results, np.array(latencies)
+
+
+def recall(results, truth, k):
+    return float(np.mean([len(set(found) & set(exact)) / max(min(k, len(exact)), 1) for found, exact in zip(results, truth)]))
+
+
+def report(label, latencies, recall_at_k):
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    print(f"{label:<28} {p50:>8.2f} {p95:>8.2f} {p99:>8.2f} {recall_at_k:>9.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Latency and recall of the search engine against exact search, offline.')
+    parser.add_argument('-m', '--embedding_model', default='text-embedding-3-small', choices=list(MODEL_DIMENSIONS))
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--index_types', type=str, default='hnsw,ivfflat')
+    parser.add_argument('--ef_search', type=str, default='20,40,80,160')
+    parser.add_argument('--probes', type=str, default='1,5,10,20')
+    parser.add_argument('--dimensions', type=int, default=None)
+    parser.add_argument('--halfvec', action='store_true')
+    parser.add_argument('--binary_column', action='store_true')
+    parser.add_argument('--candidates', type=str, default='50,100,200,400')
+    args = parser.parse_args()
+
+    env_dict = dict(get_env())
+    vector_type = 'halfvec' if args.halfvec else 'vector'
+    dim = args.dimensions or MODEL_DIMENSIONS[args.embedding_model]
+    env_dict['DB_TABLE_NAME'] = f"{env_dict['DB_TABLE_NAME']}_search_bench_{vector_type}_{dim}"
+    setup_database_and_table(args.embedding_model, env_dict, args.dimensions, vector_type, args.binary_column)
+    fill_table(env_dict, args.rows, dim, vector_type)
+    engine = SearchEngine(env_dict, StubClient(), args.embedding_model, pool_size=2)
+    queries = query_texts(engine, args.queries)
+    engine.embed_queries(queries)  # the stub is not what is measured
+
+    truth, latencies = run(engine, queries, args.k, exact=True)
+    print(f"{'':<28} {'p50 [ms]':>8} {'p95 [ms]':>8} {'p99 [ms]':>8} {'recall@' + str(args.k):>9}")
+    report("exact", latencies, 1.0)
+    for index_type in args.index_types.split(','):
+        build_index(env_dict, index_type, rebuild=True)
+        settings = args.ef_search if index_type == 'hnsw' else args.probes
+        option = 'ef_search' if index_type == 'hnsw' else 'probes'
+        for value in [int(v) for v in settings.split(',')]:
+            results, latencies = run(engine, queries, args.k, **{option: value})
+            report(f"{index_type} {option}={value}", latencies, recall(results, truth, args.k))
+        if args.binary_column:
+            for value in [int(v) for v in args.candidates.split(',')]:
+                results, latencies = run(engine, queries, args.k, candidates=value)
+                report(f"{index_type} binary candidates={value}", latencies, recall(results, truth, args.k))
+    engine.close()
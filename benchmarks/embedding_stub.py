@@ -0,0 +1,42 @@
+import os
+import re
+import sys
+import zlib
+from functools import lru_cache
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from embeddings import MODEL_DIMENSIONS
+
+word_pattern = re.compile(r"\w+")
+
+
+@lru_cache(maxsize=65536)
+def word_vector(word, dim):
+    return np.random.default_rng(zlib.crc32(word.encode("utf-8"))).standard_normal(dim).astype(np.float32)
+
+
+def stub_embedding(text, dim):
+    # Normalized sum of fixed random word vectors - texts sharing words are close, like real embeddings
+    vector = np.zeros(dim, dtype=np.float32)
+    for word in word_pattern.findall(text.lower()):
+        vector += word_vector(word, dim)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class StubEmbeddings:
+    def create(self, input, model, **kwargs):
+        texts = [input] if isinstance(input, str) else input
+        dim = kwargs.get("dimensions") or MODEL_DIMENSIONS[model]
+        data = [SimpleNamespace(index=i, embedding=stub_embedding(text, dim).tolist()) for i, text in enumerate(texts)]
+        return SimpleNamespace(data=data, model=model, usage=SimpleNamespace(prompt_tokens=0, total_tokens=0))
+
+
+class StubClient:
+    # Offline stand-in for openai.OpenAI with the embeddings.create interface used by the project
+    def __init__(self):
+        self.embeddings = StubEmbeddings()
@@ -0,0 +1,117 @@
+import argparse
+import asyncio
+import base64
+import os
+import random
+import sys
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from embedding_stub import stub_embedding
+from embeddings import MODEL_DIMENSIONS
+
+
+class FakeLimits:
+    # Sliding one minute window like the OpenAI tier limits; answers 429 with retry-after-ms when exceeded
+    def __init__(self, rpm=0, tpm=0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.window = deque()
+        self.window_tokens = 0
+
+    def retry_after(self, tokens):
+        now = time.monotonic()
+        while self.window and now - self.window[0][0] >= 60:
+            self.window_tokens -= self.window.popleft()[1]
+        if (self.rpm and len(self.window) >= self.rpm) or (self.tpm and self.window_tokens + tokens > self.tpm):
+            return 60 - (now - self.window[0][0]) if self.window else 1.0
+        self.window.append((now, tokens))
+        self.window_tokens += tokens
+        return 0
+
+
+def approximate_tokens(text):
+    return max(1, len(text) // 4)
+
+
+def create_app(latency_ms=200, jitter_ms=50, per_input_ms=0.2, rpm=0, tpm=0, error_rate=0.0, seed=1):
+    rnd = random.Random(seed)
+    limits = FakeLimits(rpm, tpm)
+    stats = {"requests": 0, "inputs": 0, "tokens": 0, "rate_limited": 0, "errors": 0}
+
+    async def delay(inputs):
+        await asyncio.sleep(max(0.0, latency_ms + rnd.uniform(-jitter_ms, jitter_ms) + per_input_ms * inputs) / 1000)
+
+    async def embeddings(request):
+        body = await request.json()
+        texts = [body["input"]] if isinstance(body["input"], str) else body["input"]
+        tokens = sum(approximate_tokens(text) for text in texts)
+        wait = limits.retry_after(tokens)
+        if wait:
+            stats["rate_limited"] += 1
+            return JSONResponse({"error": {"message": "Rate limit reached", "type": "requests"}}, status_code=429,
+                                headers={"retry-after-ms": str(int(wait * 1000))})
+        if rnd.random() < error_rate:
+            stats["errors"] += 1
+            return JSONResponse({"error": {"message": "Injected server error", "type": "server_error"}}, status_code=500)
+        await delay(len(texts))
+        dim = body.get("dimensions") or MODEL_DIMENSIONS.get(body["model"], 1536)
+        data = []
+        for i, text in enumerate(texts):
+            vector = stub_embedding(text, dim)
+            if body.get("encoding_format") == "base64":
+                embedding = base64.b64encode(np.asarray(vector, dtype="<f4").tobytes()).decode("ascii")
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        stats["requests"] += 1
+        stats["inputs"] += len(texts)
+        stats["tokens"] += tokens
+        return JSONResponse({"object": "list", "data": data, "model": body["model"],
+                             "usage": {"prompt_tokens": tokens, "total_tokens": tokens}})
+
+    async def chat_completions(request):
+        # Cluster naming - a deterministic "topic" from the first words of the prompt's quoted text
+        body = await request.json()
+        await delay(1)
+        prompt = body["messages"][-1]["content"]
+        words = prompt.split('"')[1].split()[:3] if '"' in prompt else ["topic"]
+        return JSONResponse({"id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()),
+                             "model": body["model"],
+                             "choices": [{"index": 0, "finish_reason": "stop",
+                                          "message": {"role": "assistant", "content": " ".join(words).title()}}],
+                             "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}})
+
+    async def health(request):
+        return JSONResponse(dict(stats, status="ok"))
+
+    return Starlette(routes=[
+        Route("/v1/embeddings", embeddings, methods=["POST"]),
+        Route("/v1/chat/completions", chat_completions, methods=["POST"]),
+        Route("/health", health, methods=["GET"]),
+    ])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Local stand-in for the OpenAI embeddings and chat endpoints.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency_ms', type=float, default=200, help='Base latency of a request.')
+    parser.add_argument('--jitter_ms', type=float, default=50, help='Uniform +- jitter of the latency.')
+    parser.add_argument('--per_input_ms', type=float, default=0.2, help='Extra latency per input of a batch.')
+    parser.add_argument('--rpm', type=int, default=0, help='Requests per minute before 429 (0 = unlimited).')
+    parser.add_argument('--tpm', type=int, default=0, help='Tokens per minute before 429 (0 = unlimited).')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Share of requests answered with 500.')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    print(f"Fake OpenAI API on http://{args.host}:{args.port}/v1 - set OPENAI_BASE_URL to use it")
+    uvicorn.run(create_app(args.latency_ms, args.jitter_ms, args.per_input_ms, args.rpm, args.tpm, args.error_rate,
+                           args.seed), host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,33 @@
+#!/usr/bin/env sh
+# Disposable Postgres + pgvector for the benchmarks.
+#   benchmarks/local_postgres.sh start   - start the container and print the DB_* variables
+#   benchmarks/local_postgres.sh stop    - remove the container and its data
+set -e
+
+NAME=${BENCH_PG_CONTAINER:-vectorizer-bench-pg}
+IMAGE=${BENCH_PG_IMAGE:-pgvector/pgvector:pg16}
+PORT=${BENCH_PG_PORT:-54329}
+PASSWORD=${BENCH_PG_PASSWORD:-bench}
+
+case "${1:-start}" in
+  start)
+    if ! docker ps --format '{{.Names}}' | grep -qx "$NAME"; then
+      docker run -d --rm --name "$NAME" -p "127.0.0.1:$PORT:5432" \
+        -e POSTGRES_PASSWORD="$PASSWORD" "$IMAGE" \
+        -c shared_buffers=1GB -c maintenance_work_mem=2GB -c max_wal_size=4GB >/dev/null
+    fi
+    until docker exec "$NAME" pg_isready -U postgres >/dev/null 2>&1; do sleep 1; done
+    echo "DB_HOST=127.0.0.1"
+    echo "DB_PORT=$PORT"
+    echo "DB_USER=postgres"
+    echo "DB_PASSWORD=$PASSWORD"
+    echo "DB_NAME=vectorizer_bench"
+    ;;
+  stop)
+    docker rm -f "$NAME" >/dev/null
+    ;;
+  *)
+    echo "usage: $0 [start|stop]" >&2
+    exit 1
+    ;;
+esac
@@ -0,0 +1,68 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_chunker import synthetic_pages
+from convert_2_pdf import TEXT_LINES_PER_PAGE, text_to_pdf
+
+LINE_CHARS = 80  # fits the A4 line of text_to_pdf, so PDF and text pages hold the same text
+
+
+def page_lines(words):
+    lines, line = [], ""
+    for word in words:
+        if line and len(line) + len(word) + 1 > LINE_CHARS:
+            lines.append(line)
+            line = word[:LINE_CHARS]
+        else:
+            line = f"{line} {word}" if line else word[:LINE_CHARS]
+    lines.append(line)
+    return lines
+
+
+def document_lines(pages, seed):
+    # Exactly TEXT_LINES_PER_PAGE lines per page, so both formats have the requested page count
+    words = " ".join(synthetic_pages(pages, TEXT_LINES_PER_PAGE * 12, seed)).replace("\n", " ").split()
+    lines = page_lines(words)
+    return lines[:pages * TEXT_LINES_PER_PAGE]
+
+
+def generate(out_dir, files=20, pages=10, pdf_ratio=0.5, page_jitter=0.5, seed=1):
+    # Deterministic corpus: the same parameters always produce the same files
+    os.makedirs(out_dir, exist_ok=True)
+    rnd = random.Random(seed)
+    total_pages = 0
+    for i in range(files):
+        doc_pages = max(1, round(pages * (1 + rnd.uniform(-page_jitter, page_jitter))))
+        total_pages += doc_pages
+        text = "\n".join(document_lines(doc_pages, seed * 100003 + i)) + "\n"
+        if rnd.random() < pdf_ratio:
+            with tempfile.NamedTemporaryFile("w", suffix=".txt", encoding="utf-8", delete=False) as f:
+                f.write(text)
+            text_to_pdf(f.name, os.path.join(out_dir, f"doc_{i:04d}.pdf"))
+            os.unlink(f.name)
+        else:
+            with open(os.path.join(out_dir, f"doc_{i:04d}.txt"), "w", encoding="utf-8") as f:
+                f.write(text)
+    corpus = {"files": files, "pages": pages, "pdf_ratio": pdf_ratio, "page_jitter": page_jitter, "seed": seed,
+              "total_pages": total_pages}
+    with open(os.path.join(out_dir, "corpus.json"), "w", encoding="utf-8") as f:
+        json.dump(corpus, f, indent=2)
+    return corpus
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generates a deterministic synthetic corpus of text and PDF files.')
+    parser.add_argument('-o', '--out_directory', required=True)
+    parser.add_argument('--files', type=int, default=20)
+    parser.add_argument('--pages', type=int, default=10, help='Mean pages per document.')
+    parser.add_argument('--page_jitter', type=float, default=0.5, help='Relative spread of the page count.')
+    parser.add_argument('--pdf_ratio', type=float, default=0.5, help='Share of documents written as PDF.')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    print(generate(args.out_directory, args.files, args.pages, args.pdf_ratio, args.page_jitter, args.seed))
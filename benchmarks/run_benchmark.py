@@ -0,0 +1,203 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import psycopg2
+
+from make_corpus import generate
+
+BENCH_DIR = os.path.join(ROOT, "benchmarks")
+# Same defaults as local_postgres.sh, overridable by the usual DB_* variables
+DB_DEFAULTS = {"DB_HOST": "127.0.0.1", "DB_PORT": "54329", "DB_USER": "postgres", "DB_PASSWORD": "bench",
+               "DB_NAME": "vectorizer_bench"}
+BENCH_TABLE = "bench_chunks"  # always its own table - every run drops it
+
+
+def git_revision():
+    def git(*args):
+        return subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    return git("rev-parse", "--short", "HEAD") or "unknown", bool(git("status", "--porcelain", "--untracked-files=no"))
+
+
+def start_fake_openai(args):
+    command = [sys.executable, os.path.join(BENCH_DIR, "fake_openai.py"), "--port", str(args.port),
+               "--latency_ms", str(args.latency_ms), "--jitter_ms", str(args.jitter_ms),
+               "--rpm", str(args.fake_rpm), "--tpm", str(args.fake_tpm), "--error_rate", str(args.error_rate)]
+    server = subprocess.Popen(command)
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{args.port}/health", timeout=1)
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError("The fake OpenAI server did not start")
+
+
+def fake_openai_stats(port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=5) as response:
+        return json.load(response)
+
+
+def drop_tables(env):
+    # A fresh table per run, so every run does the same work
+    try:
+        conn = psycopg2.connect(dbname=env['DB_NAME'], user=env['DB_USER'], password=env['DB_PASSWORD'],
+                                host=env['DB_HOST'], port=env['DB_PORT'])
+    except psycopg2.OperationalError:
+        return  # the database does not exist yet, main.py creates it
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {env['DB_TABLE_NAME']}, {env['DB_TABLE_NAME']}_clusters;")
+    conn.close()
+
+
+def run_step(name, command, env):
+    print(f"== {name}: {' '.join(command)}")
+    start = time.perf_counter()
+    subprocess.run(command, cwd=ROOT, env=env, check=True)
+    return round(time.perf_counter() - start, 3)
+
+
+def run_benchmark(args):
+    work_dir = os.path.abspath(args.work_directory)
+    corpus_dir = os.path.join(work_dir, "corpus")
+    out_dir = os.path.join(work_dir, "out")
+    if args.regenerate and os.path.isdir(corpus_dir):
+        shutil.rmtree(corpus_dir)
+    corpus_file = os.path.join(corpus_dir, "corpus.json")
+    if os.path.exists(corpus_file):
+        with open(corpus_file, encoding="utf-8") as f:
+            corpus = json.load(f)
+    else:
+        corpus = generate(corpus_dir, args.files, args.pages, args.pdf_ratio, seed=args.seed)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir)
+
+    env = dict(os.environ)
+    for key, value in DB_DEFAULTS.items():
+        env.setdefault(key, value)
+    env.update({"DB_TABLE_NAME": BENCH_TABLE, "OPENAI_BASE_URL": f"http://127.0.0.1:{args.port}/v1",
+                "OPENAI_API_KEY": "sk-bench", "FILE_FORMATS": ".txt,.pdf"})
+    drop_tables(env)
+
+    main_metrics = os.path.join(work_dir, "main_metrics.json")
+    cluster_metrics = os.path.join(work_dir, "cluster_metrics.json")
+    steps = {}
+    server = start_fake_openai(args)
+    try:
+        steps["main"] = run_step("main", [sys.executable, "main.py", "-i", corpus_dir, "-o", out_dir,
+                                          "-m", args.embedding_model, "-c", str(args.chunk_size),
+                                          "-v", str(args.overlapping_size), "-p", str(args.parallel_requests),
+                                          "--cache_file", "", "--metrics_file", main_metrics,
+                                          "--index_type", args.index_type] + args.main_args, env)
+        if args.clusters:
+            steps["clustering"] = run_step("clustering", [sys.executable, "clustering.py", "full",
+                                                          "-n", str(args.clusters),
+                                                          "--metrics_file", cluster_metrics], env)
+        api = fake_openai_stats(args.port)
+    finally:
+        server.terminate()
+        server.wait()
+
+    commit, dirty = git_revision()
+    result = {
+        "label": args.label,
+        "commit": commit,
+        "dirty": dirty,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "corpus": corpus,
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("compare", "results_directory")},
+        "step_seconds": steps,
+        "fake_openai": api,
+    }
+    with open(main_metrics, encoding="utf-8") as f:
+        result["main"] = json.load(f)
+    if args.clusters:
+        with open(cluster_metrics, encoding="utf-8") as f:
+            result["clustering"] = json.load(f)
+    os.makedirs(args.results_directory, exist_ok=True)
+    path = os.path.join(args.results_directory, f"{time.strftime('%Y%m%d_%H%M%S')}_{commit}{'_dirty' if dirty else ''}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+    print(f"Benchmark result written to {path}")
+    return path
+
+
+def stage_rows(result):
+    rows = {}
+    for step in ("main", "clustering"):
+        for name, stage in result.get(step, {}).get("stages", {}).items():
+            rows[f"{step}.{name}"] = stage
+    return rows
+
+
+def compare(paths):
+    # Stage by stage wall time of each result against the first one
+    results = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            results.append(json.load(f))
+    names = [f"{r['commit']}{'*' if r['dirty'] else ''} {r['label'] or ''}".strip() for r in results]
+    print(f"{'stage [wall s]':<28}" + "".join(f"{name[:18]:>20}" for name in names))
+    base = stage_rows(results[0])
+    stages = list(dict.fromkeys(name for result in results for name in stage_rows(result)))
+    for stage in stages:
+        line = f"{stage:<28}"
+        for result in results:
+            row = stage_rows(result).get(stage)
+            if row is None:
+                line += f"{'-':>20}"
+                continue
+            cell = f"{row['wall_seconds']:.2f}"
+            if stage in base and base[stage]["wall_seconds"] and result is not results[0]:
+                cell += f" ({(row['wall_seconds'] / base[stage]['wall_seconds'] - 1) * 100:+.0f}%)"
+            line += f"{cell:>20}"
+        print(line)
+    for step in ("main", "clustering"):
+        print(f"{step + ' total [s]':<28}" + "".join(f"{r['step_seconds'].get(step, 0):>20.2f}" for r in results))
+    print(f"{'main peak RSS [MB]':<28}" + "".join(f"{r['main']['peak_rss_mb'] or 0:>20.1f}" for r in results))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of main.py and clustering.py on a synthetic '
+                                                 'corpus, a fake OpenAI server and a local Postgres (local_postgres.sh).')
+    parser.add_argument('--compare', nargs='+', default=None, help='Compare saved results instead of running.')
+    parser.add_argument('--label', type=str, default='', help='Free text saved with the result.')
+    parser.add_argument('--work_directory', type=str, default=os.path.join(BENCH_DIR, 'work'))
+    parser.add_argument('--results_directory', type=str, default=os.path.join(BENCH_DIR, 'results'))
+    parser.add_argument('--files', type=int, default=50)
+    parser.add_argument('--pages', type=int, default=20)
+    parser.add_argument('--pdf_ratio', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--regenerate', action='store_true', help='Regenerate the corpus even if it exists.')
+    parser.add_argument('-m', '--embedding_model', default='text-embedding-3-small')
+    parser.add_argument('-c', '--chunk_size', type=int, default=500)
+    parser.add_argument('-v', '--overlapping_size', type=int, default=50)
+    parser.add_argument('-p', '--parallel_requests', type=int, default=4)
+    parser.add_argument('--index_type', type=str, default='auto')
+    parser.add_argument('--clusters', type=int, default=10, help='Clusters for clustering.py (0 skips it).')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency_ms', type=float, default=200)
+    parser.add_argument('--jitter_ms', type=float, default=50)
+    parser.add_argument('--fake_rpm', type=int, default=0, help='Rate limit of the fake server.')
+    parser.add_argument('--fake_tpm', type=int, default=0, help='Rate limit of the fake server.')
+    parser.add_argument('--error_rate', type=float, default=0.0)
+    parser.add_argument('main_args', nargs=argparse.REMAINDER, help='Further main.py arguments after --.')
+    args = parser.parse_args()
+    if args.main_args[:1] == ['--']:
+        args.main_args = args.main_args[1:]
+    if args.compare:
+        compare(args.compare)
+    else:
+        run_benchmark(args)
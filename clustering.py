@@ -1,9 +1,15 @@
-from arguments import get_env
+from arguments import get_env, parse_cluster_args
+import hashlib
 import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 import psycopg2
 import numpy as np
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans, kmeans_plusplus
 from openai import OpenAI
+from vector_index import embedding_column, vector_types
+from metrics import metrics
 
 def conn_db(env_dict):
     db_host = env_dict['DB_HOST']
@@ -47,39 +53,148 @@ def ensure_cluster_columns_exist(env_dict):
     cursor.close()
     conn.close()
 
-# Connecting to DB and reading of embeddings
-def load_embeddings_from_db(env_dict):
+COPY_HEADER_SIZE = 19  # signature, flags and header extension length of the binary COPY format
+
+
+class VectorCopyReader:
+    # File-like sink for COPY ... TO STDOUT (FORMAT binary) handing float32 vectors to on_rows(ids, vectors).
+    # All rows have the same size, so every buffered run of rows is decoded with one structured numpy view.
+    # copy_type is '>f4' for vector and '>f2' for halfvec columns.
+    def __init__(self, dim, with_ids, on_rows, batch_rows=1024, copy_type='>f4'):
+        self.with_ids = with_ids
+        self.on_rows = on_rows
+        fields = [('fields', '>i2')]
+        if with_ids:
+            fields += [('id_len', '>i4'), ('id', 'V16')]
+        fields += [('vector_len', '>i4'), ('dim', '>i2'), ('unused', '>i2'), ('values', copy_type, (dim,))]
+        self.row_dtype = np.dtype(fields)
+        self.batch_bytes = batch_rows * self.row_dtype.itemsize
+        self.buffer = bytearray()
+        self.header = True
+        self.rows = 0
+
+    def write(self, data):
+        self.buffer += data
+        if self.header:
+            if len(self.buffer) < COPY_HEADER_SIZE:
+                return
+            del self.buffer[:COPY_HEADER_SIZE]
+            self.header = False
+        if len(self.buffer) >= self.batch_bytes:
+            self.decode()
+
+    def decode(self):
+        n = len(self.buffer) // self.row_dtype.itemsize
+        if not n:
+            return
+        rows = np.frombuffer(self.buffer, dtype=self.row_dtype, count=n)
+        ids = [str(uuid.UUID(bytes=bytes(row_id))) for row_id in rows['id']] if self.with_ids else None
+        self.on_rows(ids, rows['values'].astype(np.float32))
+        self.rows += n
+        del rows
+        del self.buffer[:n * self.row_dtype.itemsize]
+
+    def close(self):
+        # what is left after the last row is the 2 byte trailer
+        self.decode()
+
+
+def copy_embeddings(cursor, table_name, dim, on_rows, with_ids=True, where="embedding IS NOT NULL", batch_rows=1024):
+    vector_type, _, _ = embedding_column(cursor, table_name)
+    reader = VectorCopyReader(dim, with_ids, on_rows, batch_rows, vector_types[vector_type]["copy_type"])
+    columns = "id, embedding" if with_ids else "embedding"
+    # The read time includes the on_rows callbacks, which are timed as stages of their own
+    with metrics.stage("cluster_read"):
+        cursor.copy_expert(f"COPY (SELECT {columns} FROM {table_name} WHERE {where}) TO STDOUT WITH (FORMAT binary)", reader)
+        reader.close()
+    metrics.count("cluster_read", reader.rows)
+    return reader.rows
+
+
+def stream_embeddings(env_dict, on_rows, with_ids=True, where="embedding IS NOT NULL", batch_rows=1024):
+    # Pushes batches of (ids, float32 vectors) to on_rows without holding the table in memory; returns the row count
     table_name = env_dict['DB_TABLE_NAME']
     conn = conn_db(env_dict)
+    conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
     cursor = conn.cursor()
-    cursor.execute(f"SELECT id, file, page, position, text_chunk, embedding FROM {table_name};")
-    rows = cursor.fetchall()
+    cursor.execute(f"SELECT max(vector_dims(embedding)) FROM {table_name} WHERE {where};")
+    dim = cursor.fetchone()[0]
+    rows = copy_embeddings(cursor, table_name, dim, on_rows, with_ids, where, batch_rows) if dim else 0
+    conn.commit()
+    cursor.close()
     conn.close()
+    return rows
+
+
+def load_embedding_matrix(env_dict, with_ids=True, mmap_path=None):
+    # Streams the vectors in binary form into a preallocated float32 array, or a memory mapped .npy
+    # file for tables bigger than RAM. Text and metadata are not read at all.
+    table_name = env_dict['DB_TABLE_NAME']
+    conn = conn_db(env_dict)
+    # count, dimension and COPY have to see the same snapshot
+    conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT count(*), max(vector_dims(embedding)) FROM {table_name} WHERE embedding IS NOT NULL;")
+    count, dim = cursor.fetchone()
+    dim = dim or 0
+    if mmap_path:
+        matrix = np.lib.format.open_memmap(mmap_path, mode='w+', dtype=np.float32, shape=(count, dim))
+    else:
+        matrix = np.empty((count, dim), dtype=np.float32)
+    ids = [] if with_ids else None
+    filled = 0
 
-    ids = []
-    files = []
-    pages = []
-    positions = []
-    chunks = []
-    embeddings = []
+    def on_rows(batch_ids, vectors):
+        nonlocal filled
+        matrix[filled:filled + len(vectors)] = vectors
+        filled += len(vectors)
+        if with_ids:
+            ids.extend(batch_ids)
 
-    for row in rows:
-        ids.append(row[0])
-        files.append(row[1])
-        pages.append(row[2])
-        positions.append(row[3])
-        chunks.append(row[4])
-        embedding = [float(x) for x in row[5].strip('[]').split(',')] if isinstance(row[5], str) else list(row[5])
-        embeddings.append(embedding)  # assuming that vector is stored as the type vector
+    rows = copy_embeddings(cursor, table_name, dim, on_rows, with_ids) if dim else 0
+    conn.commit()
+    cursor.close()
+    conn.close()
+    if rows != count:
+        raise RuntimeError(f"Expected {count} vectors, COPY returned {rows}")
+    if mmap_path:
+        matrix.flush()
+    return ids, matrix
 
-    return ids, files, pages, positions, chunks, np.array(embeddings)
+
+def load_metadata(env_dict, ids=None, with_text=True, batch_size=10000):
+    # id -> (file, page, position[, text_chunk]) through a server side cursor, optionally only for given ids
+    table_name = env_dict['DB_TABLE_NAME']
+    columns = "id, file, page, position" + (", text_chunk" if with_text else "")
+    conn = conn_db(env_dict)
+    cursor = conn.cursor(name="load_metadata")
+    cursor.itersize = batch_size
+    if ids is None:
+        cursor.execute(f"SELECT {columns} FROM {table_name};")
+    else:
+        cursor.execute(f"SELECT {columns} FROM {table_name} WHERE id = ANY(%s::uuid[]);", (list(ids),))
+    metadata = {str(row[0]): row[1:] for row in cursor}
+    cursor.close()
+    conn.close()
+    return metadata
+
+
+# Connecting to DB and reading of embeddings
+def load_embeddings_from_db(env_dict, mmap_path=None):
+    ids, embeddings = load_embedding_matrix(env_dict, True, mmap_path)
+    metadata = load_metadata(env_dict)
+    files, pages, positions, chunks = zip(*(metadata[row_id] for row_id in ids)) if ids else ((), (), (), ())
+    return ids, list(files), list(pages), list(positions), list(chunks), embeddings
+
+NAMING_MODEL = "gpt-4o-mini"
 
 # Cluster name via ChatGPT
 def generate_cluster_name(client, text_sample):
     prompt = f"What topic does the following text summarize?\n\n\"{text_sample}\""
+    start = time.perf_counter()
     response = client.chat.completions.create(
 
-        model="gpt-4o-mini",
+        model=NAMING_MODEL,
         messages=[
             {"role": "system", "content": "Be very brief. Specify the topic title as one to four words."},
             {"role": "user", "content": prompt}
@@ -87,51 +202,301 @@ def generate_cluster_name(client, text_sample):
         temperature=0.5,
         max_tokens=40
     )
+    metrics.observe("naming_request", time.perf_counter() - start)
     return response.choices[0].message.content.strip()
 
 # Clustering of embeddings and name of it
-def cluster_from_db(env_dict, client, n_clusters=5):
+def ensure_centroid_table_exists(env_dict):
     table_name = env_dict['DB_TABLE_NAME']
-    ids, files, pages, positions, chunks, embeddings = load_embeddings_from_db(env_dict)
-    kmeans = KMeans(n_clusters=n_clusters, random_state=42)
-    labels = kmeans.fit_predict(embeddings)
-
-    cluster_texts = {i: [] for i in range(n_clusters)}
-    for i, label in enumerate(labels):
-        cluster_texts[label].append((chunks[i], embeddings[i]))
+    conn = conn_db(env_dict)
+    cursor = conn.cursor()
+    cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS {table_name}_clusters (
+        cluster_id INTEGER PRIMARY KEY,
+        name TEXT,
+        centroid REAL[],
+        size BIGINT,
+        mean_distance DOUBLE PRECISION,
+        fitted_at TIMESTAMPTZ DEFAULT now()
+    );
+    """)
+    conn.commit()
+    cursor.close()
+    conn.close()
 
-    cluster_names = {}
-    for label, items in cluster_texts.items():
-        center = kmeans.cluster_centers_[label]
-        closest_text = min(items, key=lambda x: np.linalg.norm(x[1] - center))[0]
-        cluster_names[label] = generate_cluster_name(client, closest_text)
+def save_centroids(env_dict, centers, names, sizes, mean_distances):
+    # Replaces the stored model in one transaction
+    table_name = env_dict['DB_TABLE_NAME']
     conn = conn_db(env_dict)
     cursor = conn.cursor()
-    for i in range(len(ids)):
+    cursor.execute(f"DELETE FROM {table_name}_clusters;")
+    for label, center in enumerate(centers):
         cursor.execute(
-            f"UPDATE {table_name} SET cluster_id = %s, cluster = %s WHERE id = %s;",
-            (int(labels[i]), cluster_names[labels[i]], ids[i])
+            f"INSERT INTO {table_name}_clusters (cluster_id, name, centroid, size, mean_distance) VALUES (%s, %s, %s, %s, %s);",
+            (label, names.get(label), center.tolist(), int(sizes[label]), float(mean_distances[label]))
         )
     conn.commit()
     cursor.close()
     conn.close()
+
+def load_centroids(env_dict):
+    table_name = env_dict['DB_TABLE_NAME']
+    conn = conn_db(env_dict)
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT cluster_id, name, centroid, size, mean_distance FROM {table_name}_clusters ORDER BY cluster_id;")
+    rows = cursor.fetchall()
+    cursor.close()
+    conn.close()
+    if not rows:
+        return None
+    centers = np.array([row[2] for row in rows], dtype=np.float32)
+    names = {row[0]: row[1] for row in rows}
+    return centers, names, np.array([row[3] for row in rows]), np.array([row[4] for row in rows])
+
+def nearest_centers(vectors, centers):
+    # Euclidean distance to the closest center through |x|^2 - 2 x.c + |c|^2, one matrix product per batch
+    squared = (np.einsum('ij,ij->i', vectors, vectors)[:, None] - 2 * vectors @ centers.T
+               + np.einsum('ij,ij->i', centers, centers)[None, :])
+    labels = np.argmin(squared, axis=1)
+    return labels, np.sqrt(np.maximum(squared[np.arange(len(labels)), labels], 0))
+
+class ClusterStats:
+    # Labels, per cluster size and mean distance, and the row closest to each center, collected batch by batch
+    def __init__(self, centers):
+        self.centers = centers
+        self.ids = []
+        self.labels = []
+        self.distances = []
+        k = len(centers)
+        self.sizes = np.zeros(k, dtype=np.int64)
+        self.distance_sums = np.zeros(k)
+        self.closest = [None] * k
+        self.closest_distance = np.full(k, np.inf)
+
+    def add(self, ids, vectors):
+        with metrics.stage("cluster_assign", items=len(vectors)):
+            labels, distances = nearest_centers(vectors, self.centers)
+        self.ids += ids
+        self.labels.append(labels)
+        self.distances.append(distances)
+        np.add.at(self.sizes, labels, 1)
+        np.add.at(self.distance_sums, labels, distances)
+        for label in np.unique(labels):
+            members = np.flatnonzero(labels == label)
+            best = members[np.argmin(distances[members])]
+            if distances[best] < self.closest_distance[label]:
+                self.closest_distance[label] = distances[best]
+                self.closest[label] = ids[best]
+
+    def all_labels(self):
+        return np.concatenate(self.labels) if self.labels else np.array([], dtype=np.int64)
+
+    def mean_distances(self):
+        return self.distance_sums / np.maximum(self.sizes, 1)
+
+class LabelFile:
+    # File-like reader producing "id<TAB>cluster_id" lines for COPY FROM without building the whole text
+    def __init__(self, ids, labels):
+        self.lines = (f"{row_id}\t{int(label)}\n" for row_id, label in zip(ids, labels))
+        self.buffer = ""
+
+    def read(self, size=65536):
+        while len(self.buffer) < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            self.buffer += line
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def write_labels(env_dict, ids, labels, cluster_names):
+    # COPY the labels into a temp table and apply them with one joined UPDATE
+    with metrics.stage("cluster_write", items=len(ids)):
+        update_labels(env_dict, ids, labels, cluster_names)
+
+def update_labels(env_dict, ids, labels, cluster_names):
+    table_name = env_dict['DB_TABLE_NAME']
+    conn = conn_db(env_dict)
+    cursor = conn.cursor()
+    cursor.execute("CREATE TEMP TABLE cluster_labels (id UUID, cluster_id INTEGER) ON COMMIT DROP;")
+    cursor.execute("CREATE TEMP TABLE cluster_label_names (cluster_id INTEGER PRIMARY KEY, name TEXT) ON COMMIT DROP;")
+    cursor.copy_expert("COPY cluster_labels (id, cluster_id) FROM STDIN", LabelFile(ids, labels))
+    cursor.executemany("INSERT INTO cluster_label_names (cluster_id, name) VALUES (%s, %s);",
+                       [(int(label), name) for label, name in cluster_names.items()])
+    cursor.execute(f"""
+        UPDATE {table_name} t SET cluster_id = l.cluster_id, cluster = n.name
+        FROM cluster_labels l LEFT JOIN cluster_label_names n ON n.cluster_id = l.cluster_id
+        WHERE t.id = l.id;
+    """)
+    print(f"Updated {cursor.rowcount} rows")
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+def name_hash(text_sample):
+    return hashlib.sha256(f"{NAMING_MODEL}\0{text_sample}".encode("utf-8")).hexdigest()
+
+def cached_cluster_names(env_dict, hashes):
+    conn = conn_db(env_dict)
+    cursor = conn.cursor()
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS cluster_name_cache (
+        text_hash TEXT PRIMARY KEY,
+        name TEXT
+    );
+    """)
+    cursor.execute("SELECT text_hash, name FROM cluster_name_cache WHERE text_hash = ANY(%s);", (list(hashes),))
+    cached = dict(cursor.fetchall())
+    conn.commit()
+    cursor.close()
+    conn.close()
+    return cached
+
+def store_cluster_names(env_dict, names_by_hash):
+    conn = conn_db(env_dict)
+    cursor = conn.cursor()
+    cursor.executemany("INSERT INTO cluster_name_cache (text_hash, name) VALUES (%s, %s) ON CONFLICT DO NOTHING;",
+                       list(names_by_hash.items()))
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+def name_clusters(env_dict, client, representatives, concurrency=8):
+    # representatives: cluster label -> id of the row closest to its center. Names are cached by a hash
+    # of the representative text, the missing ones are generated with at most `concurrency` requests at once
+    representatives = {label: row_id for label, row_id in representatives.items() if row_id is not None}
+    representative_rows = load_metadata(env_dict, representatives.values())
+    texts = {label: representative_rows[row_id][3] for label, row_id in representatives.items()}
+    hashes = {label: name_hash(text) for label, text in texts.items()}
+    cached = cached_cluster_names(env_dict, hashes.values())
+    missing = [label for label in texts if hashes[label] not in cached]
+    print(f"Cluster names: {len(texts) - len(missing)} cached, {len(missing)} to generate")
+    with metrics.stage("cluster_naming", items=len(missing)), ThreadPoolExecutor(max_workers=concurrency) as executor:
+        generated = dict(zip(missing, executor.map(lambda label: generate_cluster_name(client, texts[label]), missing)))
+    store_cluster_names(env_dict, {hashes[label]: name for label, name in generated.items()})
+    return {label: generated.get(label, cached.get(hashes[label])) for label in texts}
+
+# Clustering of embeddings and name of it
+def cluster_from_db(env_dict, client, n_clusters=5, mmap_path=None):
+    ids, embeddings = load_embedding_matrix(env_dict, True, mmap_path)
+    kmeans = KMeans(n_clusters=n_clusters, random_state=42)
+    with metrics.stage("cluster_fit", items=len(embeddings)):
+        labels = kmeans.fit_predict(embeddings)
+
+    # Only the text of the row closest to each center is needed for naming
+    distances = kmeans.transform(embeddings)[np.arange(len(labels)), labels]
+    representatives = {}
+    sizes = np.bincount(labels, minlength=n_clusters)
+    mean_distances = np.bincount(labels, weights=distances, minlength=n_clusters) / np.maximum(sizes, 1)
+    for label in range(n_clusters):
+        members = np.flatnonzero(labels == label)
+        if len(members):
+            representatives[label] = ids[members[np.argmin(distances[members])]]
+
+    cluster_names = name_clusters(env_dict, client, representatives)
+    write_labels(env_dict, ids, labels, cluster_names)
+    save_centroids(env_dict, kmeans.cluster_centers_, cluster_names, sizes, mean_distances)
+    metadata = load_metadata(env_dict)
     clustered = []
-    for i in range(len(chunks)):
+    for i in range(len(ids)):
+        file, page, position, chunk = metadata[ids[i]]
         clustered.append({
-            "file": files[i],
-            "page": pages[i],
-            "position": positions[i],
-            "chunk": chunks[i],
+            "file": file,
+            "page": page,
+            "position": position,
+            "chunk": chunk,
             "cluster": int(labels[i]),
             "cluster_name": cluster_names[labels[i]]
         })
 
     return clustered
 
+def sample_embeddings(env_dict, n_samples):
+    # Random sample for the k-means++ initialization of the streamed fit
+    table_name = env_dict['DB_TABLE_NAME']
+    samples = []
+    where = (f"id IN (SELECT id FROM {table_name} WHERE embedding IS NOT NULL ORDER BY random() LIMIT {int(n_samples)})")
+    stream_embeddings(env_dict, lambda ids, vectors: samples.append(vectors), False, where)
+    return np.concatenate(samples) if samples else np.empty((0, 0), dtype=np.float32)
+
+def fit_minibatch_from_db(env_dict, client, n_clusters=25, passes=2, batch_rows=4096, seed=42):
+    # Mini-batch k-means over the streamed table; centroids and names are stored in {table}_clusters
+    sample = sample_embeddings(env_dict, max(50 * n_clusters, 10000))
+    if len(sample) < n_clusters:
+        print(f"Not enough embeddings ({len(sample)}) for {n_clusters} clusters")
+        return None
+    init, _ = kmeans_plusplus(sample, n_clusters, random_state=seed)
+    # The table is streamed in insertion order, so batches are far from random - reassigning "empty"
+    # centers to rows of the current batch would pull them all into the documents read last
+    kmeans = MiniBatchKMeans(n_clusters=n_clusters, init=init, n_init=1, reassignment_ratio=0, random_state=seed)
+    pending = []
+
+    def partial_fit(ids, vectors):
+        # partial_fit needs at least n_clusters rows, so short COPY batches are merged
+        pending.append(vectors)
+        if sum(len(v) for v in pending) >= batch_rows:
+            batch = np.concatenate(pending)
+            with metrics.stage("cluster_fit", items=len(batch)):
+                kmeans.partial_fit(batch)
+            pending.clear()
+
+    for epoch in range(passes):
+        rows = stream_embeddings(env_dict, partial_fit, False, batch_rows=batch_rows)
+        if pending and sum(len(v) for v in pending) >= n_clusters:
+            kmeans.partial_fit(np.concatenate(pending))
+        pending.clear()
+        print(f"Pass {epoch + 1}/{passes}: {rows} embeddings")
+
+    stats = ClusterStats(kmeans.cluster_centers_.astype(np.float32))
+    stream_embeddings(env_dict, stats.add, True, batch_rows=batch_rows)
+    cluster_names = name_clusters(env_dict, client, dict(enumerate(stats.closest)))
+    labels = stats.all_labels()
+    write_labels(env_dict, stats.ids, labels, cluster_names)
+    save_centroids(env_dict, stats.centers, cluster_names, stats.sizes, stats.mean_distances())
+    print(f"Fitted {n_clusters} clusters on {len(labels)} embeddings")
+    return cluster_names
+
+def assign_from_db(env_dict, client, n_clusters=25, drift_threshold=1.25, batch_rows=4096):
+    # Labels only rows with cluster_id IS NULL against the stored centroids. When their mean distance to
+    # the assigned center grows beyond drift_threshold x the distance seen at fit time, the model is refitted.
+    stored = load_centroids(env_dict)
+    if stored is None:
+        print("No stored centroids - fitting")
+        return fit_minibatch_from_db(env_dict, client, n_clusters, batch_rows=batch_rows)
+    centers, cluster_names, sizes, mean_distances = stored
+    stats = ClusterStats(centers)
+    stream_embeddings(env_dict, stats.add, True, "cluster_id IS NULL AND embedding IS NOT NULL", batch_rows)
+    if not stats.ids:
+        print("No new embeddings to assign")
+        return cluster_names
+    labels = stats.all_labels()
+    write_labels(env_dict, stats.ids, labels, cluster_names)
+    baseline = np.average(mean_distances, weights=np.maximum(sizes, 1))
+    drift = float(np.concatenate(stats.distances).mean() / baseline) if baseline else 0.0
+    total = sizes + stats.sizes
+    running_mean = (mean_distances * sizes + stats.distance_sums) / np.maximum(total, 1)
+    save_centroids(env_dict, centers, cluster_names, total, running_mean)
+    print(f"Assigned {len(labels)} embeddings, drift {drift:.3f} (threshold {drift_threshold})")
+    if drift > drift_threshold:
+        print("Drift over threshold - refitting")
+        return fit_minibatch_from_db(env_dict, client, len(centers), batch_rows=batch_rows)
+    return cluster_names
+
 # Example usage
 if __name__ == "__main__":
+    args = parse_cluster_args()
     env_dict = get_env()
     ensure_cluster_columns_exist(env_dict)
+    ensure_centroid_table_exists(env_dict)
     client = OpenAI(api_key=env_dict['OPENAI_API_KEY'])
-    clustered_result = cluster_from_db(env_dict, client, n_clusters=25)
-    print(json.dumps(clustered_result, ensure_ascii=False, indent=2))
\ No newline at end of file
+    if args.mode == 'fit':
+        fit_minibatch_from_db(env_dict, client, args.n_clusters, args.passes)
+    elif args.mode == 'assign':
+        assign_from_db(env_dict, client, args.n_clusters, args.drift_threshold)
+    else:
+        clustered_result = cluster_from_db(env_dict, client, args.n_clusters, args.mmap_file)
+        print(json.dumps(clustered_result, ensure_ascii=False, indent=2))
+    metrics.print_report()
+    if args.metrics_file:
+        metrics.write(args.metrics_file)
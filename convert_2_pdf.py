@@ -4,6 +4,14 @@ import shutil
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from office_pool import OfficePool
+from metrics import metrics
+
+# Page geometry of text files rendered to A4 - also used to number the pages of directly read text files
+TEXT_MARGIN = 40
+TEXT_LINE_HEIGHT = 15
+TEXT_LINES_PER_PAGE = int((A4[1] - 2 * TEXT_MARGIN) // TEXT_LINE_HEIGHT) + 1
 
 def classify_file(file_path):
     office_extensions = {".doc", ".docx", ".xls", ".xlsx", ".ppt", ".pptx", ".odt"}
@@ -27,6 +35,12 @@ def add_pdf_extension(filename):
     else:
         return f"{file_path.name}.pdf"
 
+def output_pdf_name(file):
+    # Name of the PDF convert_files produces for an input file - it is also the `file` column in the DB
+    if classify_file(file) == "office":
+        return f"{Path(file).stem}.pdf"
+    return add_pdf_extension("-".join(Path(file).parts))
+
 def pdf_to_pdf(pdf_file, output_pdf):
     print(f"Copying to PDF: {pdf_file}")
     shutil.copy(pdf_file, output_pdf)
@@ -48,31 +62,58 @@ def text_to_pdf(text_file, output_pdf):
 
     c = canvas.Canvas(output_pdf, pagesize=A4)
     width, height = A4
-    y_position = height - 40  # Original position on the page
+    y_position = height - TEXT_MARGIN  # Original position on the page
 
     for line in content:
-        if y_position < 40:  # PIf we are on the end of the page
+        if y_position < TEXT_MARGIN:  # PIf we are on the end of the page
             c.showPage()  # Creates new page
-            y_position = height - 40
+            y_position = height - TEXT_MARGIN
 
-        c.drawString(40, y_position, line.strip())
-        y_position -= 15  # Shift down
+        c.drawString(TEXT_MARGIN, y_position, line.strip())
+        y_position -= TEXT_LINE_HEIGHT  # Shift down
 
     c.save()
     print(f"PDF successfully created: {output_pdf}")
 
-def convert_files(files, input_directory, output_pdf_root):
-    delete_all_files(output_pdf_root)
-    for file in files:
-        path_parts = Path(file).parts[0:]
-        out_file = add_pdf_extension("-".join(path_parts))
-        file_type = classify_file(file)
-        if file_type == "office":
-            office_to_pdf(os.path.join(input_directory, file), output_pdf_root)
-        elif file_type == "pdf":
-            pdf_to_pdf(os.path.join(input_directory, file), os.path.join(output_pdf_root, out_file))
-        else:
-            text_to_pdf(os.path.join(input_directory, file), os.path.join(output_pdf_root, out_file))
+def office_to_pdf_pooled(pool, input_file, output_pdf):
+    print(f"creating PDF: {input_file}")
+    try:
+        with metrics.stage("convert", items=1):
+            pool.convert(input_file, output_pdf)
+        print(f"PDF successfully created: {output_pdf}")
+        return True
+    except Exception as e:
+        metrics.increment("conversion_errors")
+        print(f"Error converting file {input_file}: {e}")
+        return False
+
+def convert_files(files, input_directory, output_pdf_root, removed_pdfs=None, office_workers=4, office_timeout=300):
+    # removed_pdfs is given in incremental mode - only those stale PDFs are deleted instead of the whole directory.
+    # Returns the files whose conversion failed, they have no PDF in output_pdf_root
+    if removed_pdfs is None:
+        delete_all_files(output_pdf_root)
+    else:
+        for pdf in removed_pdfs:
+            stale = Path(output_pdf_root) / pdf
+            if stale.is_file():
+                stale.unlink()
+                print(f"Deleted: {stale}")
+    office_files = [file for file in files if classify_file(file) == "office"]
+    # Office documents are converted by the LibreOffice pool while PDF files are copied here.
+    # Text files are not converted at all - files_text_from_directory reads them directly
+
+    with OfficePool(min(office_workers, max(len(office_files), 1)), office_timeout) as pool, \
+            ThreadPoolExecutor(max_workers=office_workers) as executor:
+        conversions = {file: executor.submit(office_to_pdf_pooled, pool, os.path.join(input_directory, file),
+                                             os.path.join(output_pdf_root, output_pdf_name(file)))
+                       for file in office_files}
+        for file in files:
+            out_file = output_pdf_name(file)
+            file_type = classify_file(file)
+            if file_type == "pdf":
+                with metrics.stage("copy_pdf", items=1):
+                    pdf_to_pdf(os.path.join(input_directory, file), os.path.join(output_pdf_root, out_file))
+    return [file for file, conversion in conversions.items() if not conversion.result()]
 
 def delete_all_files(directory):
     path = Path(directory)
@@ -0,0 +1,150 @@
+import hashlib
+import time
+
+import numpy as np
+
+from metrics import metrics
+
+SHINGLE_BYTES = 32  # about five words of normalized text
+SHINGLE_MULTIPLIERS = np.array([0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93],
+                               dtype=np.uint64)
+NUM_PERM = 64
+HASH_SHIFT = np.uint64(32)
+MAX_INDEXED_CHUNKS = 100000  # about 30 MB of text hashes, 150 MB with near-duplicate signatures
+
+
+def lsh_bands(threshold, num_perm=NUM_PERM):
+    # (bands, rows) whose S-curve (1 / bands) ** (1 / rows) is closest to the similarity threshold
+    options = [(b, num_perm // b) for b in range(1, num_perm + 1) if num_perm % b == 0]
+    return min(options, key=lambda option: abs((1 / option[0]) ** (1 / option[1]) - threshold))
+
+
+class ChunkDeduplicator:
+    # Finds exact duplicates by a hash of the normalized text and near duplicates by MinHash signatures of
+    # word shingles in LSH buckets. Only the first occurrence (the canonical chunk) goes to the embedding;
+    # a duplicate is stored with the vector of its canonical chunk or is dropped when skip is set.
+    # A duplicate of a canonical chunk still on its way gets the vector from the written rows (ready), one
+    # of a canonical chunk written earlier has it copied in the database from the row with the same key and
+    # text (take_late). threshold 1.0 finds exact duplicates only, near duplicates are chunks whose estimated
+    # Jaccard similarity of shingles reaches the threshold. The index is cleared after max_chunks hashes,
+    # so memory stays bounded and only duplicates further apart than that are embedded again.
+    def __init__(self, threshold=1.0, skip=False, seed=1, max_chunks=MAX_INDEXED_CHUNKS):
+        self.threshold = threshold
+        self.skip = skip
+        self.max_chunks = max_chunks
+        self.exact = {}  # text digest -> canonical ((file, page, position), text digest)
+        self.unwritten = set()  # keys of canonical chunks sent to the embedding and not written yet
+        self.waiting = {}  # canonical key -> duplicate keys waiting for its vector
+        self.late = []
+        self.skipped = []
+        self.exact_duplicates = 0
+        self.near_duplicates = 0
+        self.skipped_duplicates = 0
+        self.chunks = 0
+        if threshold < 1.0:
+            rng = np.random.default_rng(seed)
+            self.a = rng.integers(1, 2 ** 63, NUM_PERM, dtype=np.uint64) | np.uint64(1)
+            self.b = rng.integers(0, 2 ** 63, NUM_PERM, dtype=np.uint64)
+            self.bands, self.rows = lsh_bands(threshold)
+        self.clear_index()
+
+    def clear_index(self):
+        self.exact.clear()
+        self.signatures = []
+        self.canonicals = []
+        if self.threshold < 1.0:
+            self.buckets = [{} for _ in range(self.bands)]
+
+    def signature(self, text):
+        # Shingles are the SHINGLE_BYTES bytes from every word start, hashed as four 64-bit words; the high half of
+        # the minimum of NUM_PERM multiply-add hashes of them is the signature. All deterministic, so runs agree.
+        raw = text.encode("utf-8")
+        data = np.frombuffer(raw + b" " * SHINGLE_BYTES, dtype=np.uint8)
+        starts = np.flatnonzero(data[:len(raw)] == 32) + 1
+        starts = np.concatenate(([0], starts[starts < len(raw)]))
+        words = data[starts[:, None] + np.arange(SHINGLE_BYTES)].view(np.uint64)
+        shingles = (words * SHINGLE_MULTIPLIERS).sum(axis=1)
+        hashes = np.multiply.outer(self.a, shingles)
+        hashes += self.b[:, None]
+        return (hashes.min(axis=1) >> HASH_SHIFT).astype(np.uint32)
+
+    def near_duplicate(self, canonical, text):
+        # Canonical of a near duplicate, or None after indexing the chunk as a new canonical one
+        signature = self.signature(text)
+        bucket_keys = [hash(signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+        for band, bucket_key in enumerate(bucket_keys):
+            for candidate in self.buckets[band].get(bucket_key, ()):
+                if np.mean(self.signatures[candidate] == signature) >= self.threshold:
+                    return self.canonicals[candidate]
+        candidate = len(self.signatures)
+        self.signatures.append(signature)
+        self.canonicals.append(canonical)
+        for band, bucket_key in enumerate(bucket_keys):
+            self.buckets[band].setdefault(bucket_key, []).append(candidate)
+        return None
+
+    def filter(self, items):
+        # Yields the canonical (key, text, tokens) items; duplicates are held back or skipped
+        for item in items:
+            start = time.perf_counter()
+            key = item[0]
+            self.chunks += 1
+            if len(self.exact) >= self.max_chunks:
+                self.clear_index()
+            # The digest of the stored text (key[3]) also identifies the canonical row in the table
+            digest = hashlib.md5(key[3].encode("utf-8"), usedforsecurity=False).digest()
+            canonical = self.exact.get(digest)
+            if canonical is not None:
+                self.exact_duplicates += 1
+            elif self.threshold < 1.0:
+                canonical = self.near_duplicate((key[:3], digest), item[1])
+                if canonical is not None:
+                    self.near_duplicates += 1
+            # Later copies of a near duplicate are found by the exact hash
+            self.exact.setdefault(digest, canonical or (key[:3], digest))
+            if canonical is None:
+                self.unwritten.add(key[:3])
+            elif self.skip:
+                self.skipped_duplicates += 1
+                self.skipped.append(key)
+            elif canonical[0] in self.unwritten:
+                self.waiting.setdefault(canonical[0], []).append(key)
+            else:
+                self.late.append((key, canonical))
+            metrics.record("dedup", time.perf_counter() - start, 1)
+            if canonical is None:
+                yield item
+
+    def ready(self, rows):
+        # (file, page, position, text, embedding) rows of the duplicates waiting for the written rows
+        duplicates = []
+        for row in rows:
+            key = row[:3]
+            if key in self.unwritten:
+                self.unwritten.discard(key)
+                duplicates += [(*duplicate, row[4]) for duplicate in self.waiting.pop(key, ())]
+        return duplicates
+
+    def take_late(self):
+        # (duplicate key, canonical) pairs of duplicates whose canonical chunk was written before they came
+        late, self.late = self.late, []
+        return late
+
+    def take_pending(self):
+        # Duplicates whose canonical chunk was never written - it failed
+        pending, self.waiting = self.waiting, {}
+        return [key for keys in pending.values() for key in keys]
+
+    def take_skipped(self):
+        skipped, self.skipped = self.skipped, []
+        return skipped
+
+    def report(self):
+        if not self.chunks:
+            return
+        metrics.increment("duplicate_chunks_exact", self.exact_duplicates)
+        metrics.increment("duplicate_chunks_near", self.near_duplicates)
+        duplicates = self.exact_duplicates + self.near_duplicates
+        print(f"\nDeduplication: {self.exact_duplicates} exact and {self.near_duplicates} near duplicates of "
+              f"{self.chunks} chunks ({duplicates / self.chunks:.1%}), "
+              f"{f'{self.skipped_duplicates} skipped (not stored)' if self.skip else 'stored with the vector of their canonical chunk'}")
@@ -0,0 +1,167 @@
+import hashlib
+import queue
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+
+class EmbeddingCache:
+    # Content addressed on-disk cache: sha256(model + normalized text) -> packed float32 vector
+    def __init__(self, path, max_size_mb=1024, commit_every=1000):
+        self.path = path
+        self.max_bytes = max_size_mb * 1024 * 1024
+        self.commit_every = commit_every
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.pending_writes = 0
+        self.touched = []
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key BLOB PRIMARY KEY,
+                model TEXT,
+                vector BLOB,
+                last_used REAL
+            ) WITHOUT ROWID
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self.size = self.conn.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+
+    @staticmethod
+    def key(model, text):
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).digest()
+
+    def get(self, model, text):
+        key = self.key(model, text)
+        row = self.conn.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.touched.append(key)
+        return np.frombuffer(row[0], dtype="<f4")
+
+    def put(self, model, text, emb):
+        # A replaced entry no longer counts, and the size limit holds between flushes too
+        blob = np.asarray(emb, dtype="<f4").tobytes()
+        key = self.key(model, text)
+        old = self.conn.execute("SELECT LENGTH(vector) FROM embeddings WHERE key = ?", (key,)).fetchone()
+        self.conn.execute("INSERT OR REPLACE INTO embeddings (key, model, vector, last_used) VALUES (?, ?, ?, ?)",
+                          (key, model, blob, time.time()))
+        self.size += len(blob) - (old[0] if old else 0)
+        self.pending_writes += 1
+        if self.size > self.max_bytes:
+            self.evict()
+        if self.pending_writes >= self.commit_every:
+            self.flush()
+
+    def touch(self):
+        if self.touched:
+            now = time.time()
+            self.conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?",
+                                  [(now, key) for key in self.touched])
+            self.touched = []
+
+    def flush(self):
+        self.touch()
+        if self.size > self.max_bytes:
+            self.evict()
+        self.conn.commit()
+        self.pending_writes = 0
+
+    def evict(self):
+        # Least recently used entries go first, down to 90 % of the size limit
+        self.touch()
+        target = int(self.max_bytes * 0.9)
+        cursor = self.conn.execute("SELECT key, LENGTH(vector) FROM embeddings ORDER BY last_used")
+        victims = []
+        for key, length in cursor:
+            if self.size <= target:
+                break
+            victims.append((key,))
+            self.size -= length
+        self.conn.executemany("DELETE FROM embeddings WHERE key = ?", victims)
+        self.evicted += len(victims)
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+    def report(self):
+        total = self.hits + self.misses
+        rate = 100 * self.hits / total if total else 0
+        print(f"Embedding cache {self.path}: {self.hits} hits, {self.misses} misses ({rate:.1f} % hit rate), "
+              f"{self.evicted} evicted, {self.size / 1024 / 1024:.1f} MB")
+
+
+def cached_embed_items(cache, model, items, embed, max_pending=4096):
+    # Serves (key, text, tokens) items from the cache and sends only the misses to `embed`, which runs
+    # in a background thread so hits are yielded right away and at most max_pending misses are queued
+    done = object()
+    misses = queue.Queue(maxsize=max_pending)
+    results = queue.Queue()
+    errors = []
+
+    def embed_misses():
+        try:
+            for result in embed(iter(misses.get, done)):
+                results.put(result)
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            results.put(done)
+
+    def drain(block):
+        while True:
+            try:
+                result = results.get(block=block)
+            except queue.Empty:
+                return
+            if result is done:
+                if errors:
+                    raise errors[0]
+                return
+            (key, text), emb = result
+            cache.put(model, text, emb)
+            yield key, emb
+
+    def send(item):
+        # The embedding thread never blocks on results, so a full queue only waits for the next batch
+        while True:
+            try:
+                misses.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                yield from drain(False)
+                if not thread.is_alive():
+                    raise RuntimeError("Embedding thread stopped")
+
+    thread = threading.Thread(target=embed_misses, daemon=True)
+    thread.start()
+    sent = False
+    try:
+        for key, text, tokens in items:
+            emb = cache.get(model, text)
+            if emb is not None:
+                yield key, emb
+            else:
+                yield from send(((key, text), text, tokens))
+            yield from drain(False)
+        yield from send(done)
+        sent = True
+        yield from drain(True)
+    finally:
+        # A consumer that raised or stopped early still ends the embedding thread; the queued misses are dropped
+        if not sent:
+            while True:
+                try:
+                    misses.get_nowait()
+                except queue.Empty:
+                    break
+            misses.put(done)
+        thread.join()
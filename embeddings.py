@@ -0,0 +1,189 @@
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import openai
+import tiktoken
+
+from metrics import metrics
+
+# OpenAI limits for the embeddings endpoint
+MAX_INPUTS_PER_REQUEST = 2048
+MAX_TOKENS_PER_REQUEST = 300000
+MAX_TOKENS_PER_INPUT = 8191
+
+# Native output size; the text-embedding-3 models can return shortened vectors through `dimensions`
+MODEL_DIMENSIONS = {"text-embedding-3-small": 1536, "text-embedding-3-large": 3072, "text-embedding-ada-002": 1536}
+SHORTENABLE_MODELS = {"text-embedding-3-small", "text-embedding-3-large"}
+
+
+class RateLimiter:
+    # Sliding one minute window over requests and tokens, shared by all worker threads
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0):
+        self.rpm = requests_per_minute
+        self.tpm = tokens_per_minute
+        self.window = deque()
+        self.window_tokens = 0
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                while self.window and now - self.window[0][0] >= 60:
+                    self.window_tokens -= self.window.popleft()[1]
+                delay = self.blocked_until - now
+                if delay <= 0:
+                    requests_ok = not self.rpm or len(self.window) < self.rpm
+                    tokens_ok = not self.tpm or not self.window or self.window_tokens + tokens <= self.tpm
+                    if requests_ok and tokens_ok:
+                        self.window.append((now, tokens))
+                        self.window_tokens += tokens
+                        return
+                    delay = 60 - (now - self.window[0][0])
+            time.sleep(max(delay, 0.05))
+
+    def block(self, seconds):
+        # Called on 429 - every thread waits until the server is ready again
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+def retry_after(error, attempt):
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        value = headers.get(header)
+        if value:
+            try:
+                return float(value) * scale
+            except ValueError:
+                pass
+    return backoff(attempt)
+
+
+def backoff(attempt):
+    # Exponential backoff capped at a minute, with jitter so parallel clients do not retry in lockstep
+    return min(60.0, 2 ** attempt) + random.uniform(0, 1)
+
+
+def fit_input(encoding, item):
+    # An input over MAX_TOKENS_PER_INPUT is rejected (400), so it is cut to the limit, counted on the text
+    # that is sent. A token is at least one byte, so short texts are not encoded again
+    key, text, _ = item
+    if len(text.encode("utf-8")) <= MAX_TOKENS_PER_INPUT:
+        return item
+    ids = encoding.encode(text, disallowed_special=())
+    if len(ids) <= MAX_TOKENS_PER_INPUT:
+        return key, text, len(ids)
+    metrics.increment("truncated_inputs")
+    limit = MAX_TOKENS_PER_INPUT
+    while len(ids) > MAX_TOKENS_PER_INPUT:
+        # A cut inside a multi-byte character can encode to a few more tokens, so the limit shrinks until it fits
+        text = encoding.decode(ids[:limit], errors="ignore")
+        ids = encoding.encode(text, disallowed_special=())
+        limit -= 16
+    return key, text, len(ids)
+
+
+def make_batches(items, max_inputs=MAX_INPUTS_PER_REQUEST, max_tokens=MAX_TOKENS_PER_REQUEST, encoding=None):
+    # items are (key, text, tokens); yields lists of items fitting into one request, with the inputs fitted
+    # to the per-input limit when the encoding is given
+    batch = []
+    batch_tokens = 0
+    for item in items:
+        if encoding is not None:
+            item = fit_input(encoding, item)
+        tokens = item[2]
+        if batch and (len(batch) >= max_inputs or batch_tokens + tokens > max_tokens):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(item)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+
+def request_dimensions(model, dim):
+    # `dimensions` argument for a table of dim-sized vectors, None when the model's native size fits
+    if not dim or dim == MODEL_DIMENSIONS[model]:
+        return None
+    if model not in SHORTENABLE_MODELS or dim > MODEL_DIMENSIONS[model]:
+        raise ValueError(f"{model} cannot produce {dim}-dimensional embeddings")
+    return dim
+
+
+def embed_batch(client, model, batch, limiter, max_retries=6, dimensions=None):
+    tokens = sum(item[2] for item in batch)
+    options = {"dimensions": dimensions} if dimensions else {}
+    attempt = 0
+    while True:
+        waiting = time.perf_counter()
+        limiter.acquire(tokens)
+        metrics.observe("rate_limit_wait", time.perf_counter() - waiting)
+        start = time.perf_counter()
+        try:
+            with metrics.stage("embed"):
+                response = client.embeddings.create(input=[item[1] for item in batch], model=model, **options)
+            metrics.observe("embedding_request", time.perf_counter() - start)
+            metrics.count("embed", len(batch), tokens)
+            # response.data keeps the order of the inputs, but index is authoritative
+            return [(batch[d.index][0], d.embedding) for d in response.data]
+        except openai.RateLimitError as e:
+            metrics.increment("embedding_rate_limited")
+            error = e
+            delay = retry_after(e, attempt)
+            limiter.block(delay)
+        except (openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError) as e:
+            metrics.increment("embedding_errors")
+            error = e
+            delay = retry_after(e, attempt)
+        attempt += 1
+        metrics.increment("embedding_retries")
+        if attempt > max_retries:
+            raise RuntimeError(f"Embedding request failed after {max_retries} retries: {error}")
+        print(f"\nRetrying embedding request in {delay:.1f}s (attempt {attempt})")
+        time.sleep(delay)
+
+
+def embed_items(client, model, items, concurrency=4, max_inputs=MAX_INPUTS_PER_REQUEST,
+                max_tokens=MAX_TOKENS_PER_REQUEST, requests_per_minute=0, tokens_per_minute=0, dimensions=None,
+                max_retries=6, on_failure=None):
+    # Yields (key, embedding) pairs as batches complete; at most `concurrency` requests in flight.
+    # With on_failure a batch that fails for good is passed to on_failure(batch, error) instead of ending
+    # the run; a rejected batch (400) is split first, so only the offending inputs fail
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    batches = make_batches(items, max_inputs, max_tokens, tiktoken.encoding_for_model(model))
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = {}
+
+        def submit(batch):
+            future = executor.submit(embed_batch, client, model, batch, limiter, max_retries, dimensions)
+            pending[future] = batch
+
+        def completed():
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    if on_failure is None:
+                        raise
+                    if isinstance(e, openai.BadRequestError) and len(batch) > 1:
+                        submit(batch[:len(batch) // 2])
+                        submit(batch[len(batch) // 2:])
+                    else:
+                        on_failure(batch, e)
+                    continue
+                yield from result
+
+        for batch in batches:
+            submit(batch)
+            if len(pending) >= concurrency:
+                yield from completed()
+        while pending:
+            yield from completed()
@@ -0,0 +1,167 @@
+import html
+import json
+import math
+import multiprocessing
+import os
+import random
+import re
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from pdf_2_text import get_encoding, pdf_page_count, extract_page_range, prices, text_price
+
+TEXT_BLOCK_SIZE = 64 * 1024
+Z_95 = 1.96
+
+# Text parts of the zipped office formats - read directly instead of converting with LibreOffice
+office_xml_parts = {
+    ".docx": re.compile(r"word/(document|header\d*|footer\d*|footnotes|endnotes)\.xml"),
+    ".xlsx": re.compile(r"xl/(sharedStrings|worksheets/sheet\d+)\.xml"),
+    ".pptx": re.compile(r"ppt/(slides/slide\d+|notesSlides/notesSlide\d+)\.xml"),
+    ".odt": re.compile(r"content\.xml"),
+}
+xml_tag = re.compile(r"<[^>]+>")
+# Legacy binary office files: runs of printable 8-bit or UTF-16LE text, like `strings`
+printable_8bit = re.compile(rb"[\x20-\x7e\xa0-\xff\t\r\n]{4,}")
+printable_utf16 = re.compile(rb"(?:[\x20-\x7e\xa0-\xff\t\r\n][\x00-\x04]){4,}")
+
+
+def count_tokens(encoding, text):
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def sampled_total(unit_tokens, units):
+    # Extrapolates the mean of the sampled units; 95 % bound with finite population correction
+    k = len(unit_tokens)
+    mean = sum(unit_tokens) / k
+    if k == units or k < 2:
+        return round(mean * units), 0
+    variance = sum((t - mean) ** 2 for t in unit_tokens) / (k - 1)
+    error = Z_95 * math.sqrt(variance / k) * math.sqrt((units - k) / (units - 1)) * units
+    return round(mean * units), round(error)
+
+
+def pdf_tokens(encoding, path, sample_units, rnd):
+    pages = pdf_page_count(path)
+    if pages <= sample_units:
+        return sum(count_tokens(encoding, text) for text in extract_page_range(path, 0, pages)), 0, pages, False
+    sample = sorted(rnd.sample(range(pages), sample_units))
+    unit_tokens = [count_tokens(encoding, extract_page_range(path, page, page + 1)[0]) for page in sample]
+    return *sampled_total(unit_tokens, pages), pages, True
+
+
+def text_tokens(encoding, path, sample_units, rnd):
+    size = os.path.getsize(path)
+    blocks = max(math.ceil(size / TEXT_BLOCK_SIZE), 1)
+    with open(path, "rb") as f:
+        if blocks <= sample_units:
+            return count_tokens(encoding, f.read().decode("utf-8", errors="ignore")), 0, blocks, False
+        unit_tokens = []
+        for block in sorted(rnd.sample(range(blocks - 1), sample_units)):
+            # Only full blocks are sampled, the partial last block is scaled like the others
+            f.seek(block * TEXT_BLOCK_SIZE)
+            unit_tokens.append(count_tokens(encoding, f.read(TEXT_BLOCK_SIZE).decode("utf-8", errors="ignore")))
+    tokens, error = sampled_total(unit_tokens, size / TEXT_BLOCK_SIZE)
+    return tokens, error, blocks, True
+
+
+def office_xml_tokens(encoding, path, extension):
+    parts = office_xml_parts[extension]
+    tokens = 0
+    with zipfile.ZipFile(path) as archive:
+        for name in archive.namelist():
+            if parts.fullmatch(name):
+                text = html.unescape(xml_tag.sub(" ", archive.read(name).decode("utf-8", errors="ignore")))
+                tokens += count_tokens(encoding, re.sub(r"\s+", " ", text))
+    return tokens
+
+
+def legacy_office_tokens(encoding, path):
+    with open(path, "rb") as f:
+        data = f.read()
+    runs = [run.decode("latin-1") for run in printable_8bit.findall(data)]
+    runs += [run.decode("utf-16-le", errors="ignore") for run in printable_utf16.findall(data)]
+    return count_tokens(encoding, " ".join(runs))
+
+
+def estimate_file(path, model_name, sample_units=50, seed=42):
+    encoding = get_encoding(model_name)
+    extension = Path(path).suffix.lower()
+    rnd = random.Random(f"{seed}:{path}")
+    result = {"file": str(path), "extension": extension, "bytes": os.path.getsize(path)}
+    try:
+        if extension == ".pdf":
+            tokens, error, units, sampled = pdf_tokens(encoding, path, sample_units, rnd)
+            method = "pdf pages"
+        elif extension in office_xml_parts:
+            tokens, error, units, sampled = office_xml_tokens(encoding, path, extension), 0, 1, False
+            method = "office xml"
+        elif extension in (".doc", ".xls", ".ppt"):
+            tokens, error, units, sampled = legacy_office_tokens(encoding, path), 0, 1, False
+            method = "binary strings (approximate)"
+        else:
+            tokens, error, units, sampled = text_tokens(encoding, path, sample_units, rnd)
+            method = "text blocks"
+    except Exception as e:
+        tokens, error, units, sampled, method = 0, 0, 0, False, f"error: {e}"
+    result.update({"tokens": tokens, "error_95": error, "units": units, "sampled": sampled, "method": method})
+    return result
+
+
+def estimate_tokens(root_dir, files, model_name, chunk_size, overlap, workers=None, sample_units=50):
+    paths = [os.path.join(root_dir, file) for file in files]
+    # Overlapping chunks embed `overlap` tokens twice per chunk_size - overlap tokens of text
+    overlap_factor = chunk_size / max(chunk_size - overlap, 1)
+    with ProcessPoolExecutor(workers or os.cpu_count(), mp_context=multiprocessing.get_context("spawn")) as executor:
+        per_file = list(executor.map(estimate_file, paths, [model_name] * len(paths), [sample_units] * len(paths),
+                                     chunksize=8))
+
+    by_extension = {}
+    for result in per_file:
+        result["file"] = os.path.relpath(result["file"], root_dir)
+        ext = by_extension.setdefault(result["extension"], {"files": 0, "bytes": 0, "tokens": 0, "error_95": 0})
+        ext["files"] += 1
+        ext["bytes"] += result["bytes"]
+        ext["tokens"] += result["tokens"]
+        ext["error_95"] += result["error_95"] ** 2
+    for ext in by_extension.values():
+        ext["error_95"] = round(math.sqrt(ext["error_95"]))
+
+    tokens = sum(result["tokens"] for result in per_file)
+    # Errors of independently sampled files add in quadrature
+    error = round(math.sqrt(sum(result["error_95"] ** 2 for result in per_file)))
+    embedded_tokens = round(tokens * overlap_factor)
+    embedded_error = round(error * overlap_factor)
+    return {
+        "model": model_name,
+        "chunk_size": chunk_size,
+        "overlap": overlap,
+        "files": len(per_file),
+        "tokens": tokens,
+        "error_95": error,
+        "embedded_tokens": embedded_tokens,
+        "embedded_error_95": embedded_error,
+        "price_usd": {model: {"estimate": text_price(model, embedded_tokens),
+                              "low": text_price(model, max(embedded_tokens - embedded_error, 0)),
+                              "high": text_price(model, embedded_tokens + embedded_error)}
+                      for model in prices},
+        "by_extension": by_extension,
+        "by_file": per_file,
+    }
+
+
+def print_estimate(report):
+    print(f"{'extension':<10} {'files':>7} {'MB':>10} {'tokens':>14} {'+/- 95 %':>12}")
+    for extension, ext in sorted(report["by_extension"].items()):
+        print(f"{extension:<10} {ext['files']:>7} {ext['bytes'] / 1024 / 1024:>10.1f} {ext['tokens']:>14} {ext['error_95']:>12}")
+    print(f"Total tokens {report['tokens']} +/- {report['error_95']}, "
+          f"embedded with overlap {report['embedded_tokens']} +/- {report['embedded_error_95']}")
+    for model, price in report["price_usd"].items():
+        print(f"Price for {model}: {price['estimate']} USD ({price['low']} - {price['high']})")
+
+
+def write_estimate(report, path):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Estimate written to {path}")
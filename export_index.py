@@ -0,0 +1,65 @@
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+from openai import OpenAI
+
+from arguments import get_env, parse_export_args
+from clustering import conn_db, copy_embeddings, load_metadata
+from embeddings import request_dimensions
+from local_index import IndexWriter, LocalIndex
+from store_2_db import normalize_text
+
+
+def default_ivf_lists(count):
+    # Same rule of thumb as the IVFFlat index in the database
+    return max(count // 1000, 1) if count <= 1000000 else int(count ** 0.5)
+
+
+def export_index(env_dict, out_dir, dtype="float16", ivf_lists=0, with_text=False, batch_rows=4096, seed=42):
+    # Streams the table with binary COPY straight into a quantized memory mapped matrix next to its metadata
+    table_name = env_dict['DB_TABLE_NAME']
+    conn = conn_db(env_dict)
+    conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT count(*), max(vector_dims(embedding)) FROM {table_name} WHERE embedding IS NOT NULL;")
+    count, dim = cursor.fetchone()
+    if not count:
+        print(f"No embeddings in {table_name}")
+        conn.close()
+        return None
+    print(f"Exporting {count} x {dim} embeddings from {table_name} to {out_dir} as {dtype}")
+    writer = IndexWriter(out_dir, count, dim, dtype)
+    copy_embeddings(cursor, table_name, dim, writer.add, True, batch_rows=batch_rows)
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+    centers = None
+    if ivf_lists:
+        ivf_lists = min(default_ivf_lists(count) if ivf_lists < 0 else ivf_lists, count)
+        sample = writer.sample(min(max(50 * ivf_lists, 10000), 200000), seed)
+        kmeans = MiniBatchKMeans(n_clusters=ivf_lists, n_init=1, batch_size=4096, random_state=seed).fit(sample)
+        centers = kmeans.cluster_centers_.astype(np.float32)
+        print(f"Trained IVF coarse quantizer with {ivf_lists} lists on {len(sample)} vectors")
+    metadata = load_metadata(env_dict, with_text=with_text)
+    info = writer.finish(metadata, centers, {"table": table_name, "with_text": with_text})
+    size = info["count"] * info["dimensions"] * np.dtype(dtype).itemsize
+    print(f"Index written to {out_dir}: {size / 1024 / 1024:.1f} MB of vectors "
+          f"({size / (count * dim * 4):.0%} of float32), {info['ivf_lists']} IVF lists")
+    return info
+
+
+if __name__ == "__main__":
+    args = parse_export_args()
+    env_dict = get_env()
+    if args.mode == 'export':
+        export_index(env_dict, args.index_directory, args.dtype, args.ivf_lists, args.with_text)
+    else:
+        index = LocalIndex(args.index_directory)
+        client = OpenAI(api_key=env_dict['OPENAI_API_KEY'])
+        dimensions = request_dimensions(args.embedding_model, index.info["dimensions"])
+        options = {"dimensions": dimensions} if dimensions else {}
+        emb = client.embeddings.create(input=[normalize_text(args.query).strip()], model=args.embedding_model,
+                                       **options).data[0].embedding
+        for row in index.search(np.array([emb]), args.k, args.nprobe)[0]:
+            print(f"{row['distance']:.4f} {row['file']} page {row['page']} #{row['position']} {row.get('text', '')[:100]}")
+        index.close()
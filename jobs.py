@@ -0,0 +1,176 @@
+import json
+import os
+import socket
+import threading
+
+import psycopg2
+
+JOB_STATES = ("pending", "running", "done", "failed")
+POLL_SECONDS = 5
+
+
+def connect(env_dict):
+    return psycopg2.connect(dbname=env_dict['DB_NAME'], user=env_dict['DB_USER'], password=env_dict['DB_PASSWORD'],
+                            host=env_dict['DB_HOST'], port=env_dict['DB_PORT'])
+
+
+def jobs_table(env_dict):
+    return f"{env_dict['DB_TABLE_NAME']}_jobs"
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def ensure_jobs_table(env_dict):
+    # One job per input file (path relative to the input directory every machine mounts)
+    conn = connect(env_dict)
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {jobs_table(env_dict)} (
+            file TEXT PRIMARY KEY,
+            size BIGINT,
+            params JSONB,
+            status TEXT NOT NULL DEFAULT 'pending',
+            worker TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            heartbeat TIMESTAMPTZ,
+            error TEXT
+        );
+        """)
+    conn.commit()
+    conn.close()
+
+
+def enqueue_jobs(env_dict, in_directory, files, params):
+    # Done jobs are kept, so a restarted coordinator continues the backfill; failed jobs get a new chance
+    sizes = [os.path.getsize(os.path.join(in_directory, f)) for f in files]
+    conn = connect(env_dict)
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+        INSERT INTO {jobs_table(env_dict)} AS j (file, size, params)
+        SELECT file, size, %s::jsonb FROM unnest(%s::text[], %s::bigint[]) AS f(file, size)
+        ON CONFLICT (file) DO UPDATE SET status = 'pending', attempts = 0, error = NULL, size = EXCLUDED.size,
+            params = EXCLUDED.params
+        WHERE j.status = 'failed' OR j.params IS DISTINCT FROM EXCLUDED.params;
+        """, (json.dumps(params), list(files), sizes))
+        enqueued = cursor.rowcount
+    conn.commit()
+    conn.close()
+    return enqueued
+
+
+def job_params(conn, table):
+    with conn.cursor() as cursor:
+        cursor.execute(f"SELECT params FROM {table} WHERE status IN ('pending', 'running') LIMIT 1;")
+        row = cursor.fetchone()
+    conn.commit()
+    return row[0] if row else None
+
+
+def claim_jobs(conn, table, worker, count):
+    # Largest files first, so the long jobs do not end up as the tail of the run. SKIP LOCKED lets the
+    # workers claim concurrently without waiting on each other's rows
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+        WITH claimed AS (
+            SELECT file FROM {table} WHERE status = 'pending'
+            ORDER BY size DESC LIMIT %s FOR UPDATE SKIP LOCKED
+        )
+        UPDATE {table} j SET status = 'running', worker = %s, heartbeat = now(), attempts = j.attempts + 1
+        FROM claimed WHERE j.file = claimed.file
+        RETURNING j.file;
+        """, (count, worker))
+        files = [row[0] for row in cursor.fetchall()]
+    conn.commit()
+    return files
+
+
+def reclaim_stale_jobs(conn, table, stale_seconds, max_attempts):
+    # Jobs of a worker that stopped sending heartbeats go back to the queue, or fail after max_attempts
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+        UPDATE {table} SET status = CASE WHEN attempts >= %s THEN 'failed' ELSE 'pending' END,
+            error = 'worker ' || worker || ' stopped sending heartbeats', worker = NULL
+        WHERE status = 'running' AND heartbeat < now() - %s * interval '1 second'
+        RETURNING file, status;
+        """, (max_attempts, stale_seconds))
+        reclaimed = cursor.fetchall()
+    conn.commit()
+    for file, status in reclaimed:
+        print(f"Reclaimed stale job {file} ({status})")
+    return reclaimed
+
+
+def finish_jobs(conn, table, worker, files):
+    # Only jobs still owned by the worker - a reclaimed job belongs to whoever claimed it next
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+        UPDATE {table} SET status = 'done', error = NULL
+        WHERE file = ANY(%s) AND worker = %s AND status = 'running';
+        """, (files, worker))
+        finished = cursor.rowcount
+    conn.commit()
+    return finished
+
+
+def fail_jobs(conn, table, worker, files, error, max_attempts):
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+        UPDATE {table} SET status = CASE WHEN attempts >= %s THEN 'failed' ELSE 'pending' END,
+            error = %s, worker = NULL
+        WHERE file = ANY(%s) AND worker = %s AND status = 'running';
+        """, (max_attempts, str(error), files, worker))
+    conn.commit()
+
+
+def job_counts(conn, table):
+    with conn.cursor() as cursor:
+        cursor.execute(f"SELECT status, count(*) FROM {table} GROUP BY status;")
+        counts = dict(cursor.fetchall())
+    conn.commit()
+    return {state: counts.get(state, 0) for state in JOB_STATES}
+
+
+def failed_jobs(conn, table):
+    with conn.cursor() as cursor:
+        cursor.execute(f"SELECT file, attempts, error FROM {table} WHERE status = 'failed' ORDER BY file;")
+        failed = cursor.fetchall()
+    conn.commit()
+    return failed
+
+
+class Heartbeat(threading.Thread):
+    # Keeps the claimed jobs of a worker alive from its own connection while the files are processed
+    def __init__(self, env_dict, worker, interval=30):
+        super().__init__(daemon=True)
+        self.env_dict = env_dict
+        self.worker = worker
+        self.interval = interval
+        self.files = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        conn = None
+        while not self.stopped.wait(self.interval):
+            files = self.files
+            if not files:
+                continue
+            try:
+                if conn is None:
+                    conn = connect(self.env_dict)
+                    conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(f"UPDATE {jobs_table(self.env_dict)} SET heartbeat = now() "
+                                   f"WHERE file = ANY(%s) AND worker = %s AND status = 'running';",
+                                   (files, self.worker))
+            except psycopg2.Error as e:
+                print(f"\nHeartbeat failed: {e}")
+                if conn is not None:
+                    conn.close()
+                conn = None
+        if conn is not None:
+            conn.close()
+
+    def stop(self):
+        self.stopped.set()
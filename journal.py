@@ -0,0 +1,141 @@
+import json
+import os
+import threading
+from collections import Counter
+from pathlib import Path
+
+JOURNAL_FILE = ".ingest_journal.jsonl"
+
+
+class IngestJournal:
+    # Append-only checkpoint log of an ingestion run in the output directory, one JSON object per line:
+    #   {"run": parameters}                      first line of a run
+    #   {"open": file}                           before the first chunk of the file is embedded
+    #   {"stored": {file: chunks}}               after every committed COPY batch
+    #   {"done": file}                           all chunks of the file are committed
+    #   {"failed": [file, page, position], ...}  a chunk that could not be embedded or stored,
+    #                                            page 0 for a file whose text could not be extracted
+    #   {"complete": stored}                     the run finished
+    # Lines are fsynced after the commit they describe. Single chunks are only resumed from the table
+    # itself, which also covers a batch committed just before a crash but not journaled yet.
+    def __init__(self, out_directory, run, resume=False):
+        self.path = Path(out_directory) / JOURNAL_FILE
+        self.lock = threading.Lock()
+        self.done = set()
+        self.opened = set()
+        self.failed = []
+        self.emitted = Counter()
+        self.committed = Counter()
+        self.failed_files = Counter()
+        self.closed = set()
+        self.resumed = resume and self.path.exists()
+        if resume and not self.resumed:
+            print(f"No journal in {out_directory}, starting a new run")
+        if self.resumed:
+            self.load(run)
+        self.file = open(self.path, "a" if self.resumed else "w", encoding="utf-8")
+        if not self.resumed:
+            self.append({"run": run})
+
+    def load(self, run):
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # torn last line of a crashed run
+                if "run" in entry and entry["run"] != run:
+                    raise ValueError(f"The journal {self.path} is of a run with other parameters "
+                                     f"({entry['run']}) - start a new run without --resume")
+                if "open" in entry:
+                    self.opened.add(entry["open"])
+                if "done" in entry:
+                    self.done.add(entry["done"])
+        print(f"Resuming: {len(self.done)} files are already stored")
+
+    def append(self, entry):
+        with self.lock:
+            self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def track(self, items):
+        # Counts the chunk items of each file; the pipeline emits the chunks of a file together,
+        # so a file has all its chunks counted when the next one starts
+        previous = None
+        for item in items:
+            file_name = item[0][0]
+            if file_name != previous:
+                if previous is not None:
+                    self.close_file(previous)
+                previous = file_name
+                self.append({"open": file_name})
+            with self.lock:
+                self.emitted[file_name] += 1
+            yield item
+        if previous is not None:
+            self.close_file(previous)
+
+    def close_file(self, file_name):
+        with self.lock:
+            self.closed.add(file_name)
+        self.check_files()
+
+    def stored(self, keys):
+        # keys of committed rows; also called for chunks skipped because they were stored by an earlier run
+        counts = Counter(key[0] for key in keys)
+        with self.lock:
+            self.committed.update(counts)
+        if counts:
+            self.append({"stored": counts})
+        self.check_files()
+
+    def failure(self, key, error):
+        file_name, page, position = key[:3]
+        with self.lock:
+            self.failed.append((file_name, page, position, str(error)))
+            self.failed_files[file_name] += 1
+        self.append({"failed": [file_name, page, position], "error": str(error)})
+        self.check_files()
+
+    def document_failure(self, file_name, error):
+        # A document whose text could not be extracted at all; it has no chunks, page 0 stands for the file
+        self.failure((file_name, 0, 0), error)
+
+    def check_files(self):
+        finished = []
+        with self.lock:
+            for file_name in list(self.closed):
+                if self.committed[file_name] + self.failed_files[file_name] >= self.emitted[file_name]:
+                    self.closed.discard(file_name)
+                    if not self.failed_files[file_name]:
+                        finished.append(file_name)
+            self.done.update(finished)
+        for file_name in finished:
+            self.append({"done": file_name})
+
+    def unfinished(self):
+        # Files an interrupted run started but did not finish, the only ones with chunks to skip on resume
+        return self.opened - self.done
+
+    def failed_file_names(self):
+        return set(self.failed_files)
+
+    def complete(self, stored):
+        self.append({"complete": stored})
+
+    def close(self):
+        self.file.close()
+
+    def report(self, limit=20):
+        if not self.failed:
+            return
+        print(f"\n{len(self.failed)} chunks or documents of {len(self.failed_files)} files failed permanently "
+              f"(listed in {self.path}, run again with --resume to retry them):")
+        for file_name, page, position, error in self.failed[:limit]:
+            if page:
+                print(f"  {file_name} page {page} chunk {position}: {error}")
+            else:
+                print(f"  {file_name}: {error}")
+        if len(self.failed) > limit:
+            print(f"  ... and {len(self.failed) - limit} more")
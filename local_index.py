@@ -0,0 +1,196 @@
+import json
+import os
+import time
+
+import numpy as np
+
+# Only NumPy is needed to search an exported index - no database, no scikit-learn
+INDEX_FILE = "index.json"
+VECTORS_FILE = "vectors.npy"
+SCALES_FILE = "scales.npy"
+CENTROIDS_FILE = "ivf_centroids.npy"
+LIST_OFFSETS_FILE = "ivf_offsets.npy"
+METADATA_FILE = "metadata.jsonl"
+METADATA_OFFSETS_FILE = "metadata_offsets.npy"
+
+
+def normalized(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def quantize(vectors, dtype):
+    # float16 keeps the values, int8 stores each unit vector scaled to +-127 with its own scale
+    if dtype == "float16":
+        return vectors.astype(np.float16), None
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales = np.maximum(scales, 1e-12)
+    return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+
+class IndexWriter:
+    # Builds the on-disk index from batches of (ids, vectors) without holding float32 copies of the table
+    def __init__(self, out_dir, count, dim, dtype="float16"):
+        if dtype not in ("float16", "int8"):
+            raise ValueError(f"Unsupported index dtype {dtype}")
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.count = count
+        self.dim = dim
+        self.dtype = dtype
+        self.unsorted_path = os.path.join(out_dir, "vectors.unsorted.npy")
+        self.vectors = np.lib.format.open_memmap(self.unsorted_path, mode="w+", dtype=dtype, shape=(count, dim))
+        self.scales = np.ones(count, dtype=np.float32)
+        self.ids = []
+        self.filled = 0
+
+    def add(self, ids, vectors):
+        values, scales = quantize(normalized(vectors), self.dtype)
+        end = self.filled + len(values)
+        self.vectors[self.filled:end] = values
+        if scales is not None:
+            self.scales[self.filled:end] = scales
+        self.ids.extend(ids)
+        self.filled = end
+
+    def rows(self, start, end):
+        # Dequantized float32 rows, for training and assigning the coarse quantizer
+        return self.vectors[start:end].astype(np.float32) * self.scales[start:end, None]
+
+    def sample(self, n, seed=42):
+        rows = np.sort(np.random.default_rng(seed).choice(self.filled, min(n, self.filled), replace=False))
+        return self.vectors[rows].astype(np.float32) * self.scales[rows, None]
+
+    def finish(self, metadata, centers=None, extra=None, block_rows=65536):
+        # metadata: id -> (file, page, position[, text]). With IVF centers the rows are reordered so each
+        # inverted list is one contiguous slice of the matrix.
+        if self.filled != self.count:
+            raise RuntimeError(f"Expected {self.count} vectors, got {self.filled}")
+        order = None
+        if centers is not None:
+            centers = normalized(centers)
+            labels = np.empty(self.count, dtype=np.int32)
+            for start in range(0, self.count, block_rows):
+                labels[start:start + block_rows] = np.argmax(self.rows(start, start + block_rows) @ centers.T, axis=1)
+            order = np.argsort(labels, kind="stable")
+            offsets = np.searchsorted(labels[order], np.arange(len(centers) + 1)).astype(np.int64)
+            np.save(os.path.join(self.out_dir, CENTROIDS_FILE), centers)
+            np.save(os.path.join(self.out_dir, LIST_OFFSETS_FILE), offsets)
+            final = np.lib.format.open_memmap(os.path.join(self.out_dir, VECTORS_FILE), mode="w+",
+                                              dtype=self.dtype, shape=(self.count, self.dim))
+            for start in range(0, self.count, block_rows):
+                final[start:start + block_rows] = self.vectors[order[start:start + block_rows]]
+            final.flush()
+            del final
+            self.scales = self.scales[order]
+            self.ids = [self.ids[i] for i in order]
+        self.vectors.flush()
+        del self.vectors
+        if order is None:
+            os.replace(self.unsorted_path, os.path.join(self.out_dir, VECTORS_FILE))
+        else:
+            os.remove(self.unsorted_path)
+        if self.dtype == "int8":
+            np.save(os.path.join(self.out_dir, SCALES_FILE), self.scales)
+
+        offsets = np.empty(self.count + 1, dtype=np.int64)
+        with open(os.path.join(self.out_dir, METADATA_FILE), "wb") as f:
+            for i, row_id in enumerate(self.ids):
+                offsets[i] = f.tell()
+                # rows deleted between the vector and the metadata read keep only their id
+                row = metadata.get(row_id, (None, None, None))
+                entry = {"id": row_id, "file": row[0], "page": row[1], "position": row[2]}
+                if len(row) > 3:
+                    entry["text"] = row[3]
+                f.write(json.dumps(entry, ensure_ascii=False).encode("utf-8") + b"\n")
+            offsets[self.count] = f.tell()
+        np.save(os.path.join(self.out_dir, METADATA_OFFSETS_FILE), offsets)
+
+        info = {"count": self.count, "dimensions": self.dim, "dtype": self.dtype,
+                "ivf_lists": 0 if centers is None else len(centers), "exported_at": time.time()}
+        info.update(extra or {})
+        with open(os.path.join(self.out_dir, INDEX_FILE), "w", encoding="utf-8") as f:
+            json.dump(info, f, indent=2)
+        return info
+
+
+class TopK:
+    # Running best k (score, row) per query, merged block by block
+    def __init__(self, n_queries, k):
+        self.k = k
+        self.scores = np.full((n_queries, k), -np.inf, dtype=np.float32)
+        self.rows = np.full((n_queries, k), -1, dtype=np.int64)
+
+    def merge(self, queries, scores, rows):
+        # queries: indices of the queries scored; scores: (len(queries), n) for the matrix rows `rows`
+        candidates = np.concatenate([self.scores[queries], scores], axis=1)
+        candidate_rows = np.concatenate([self.rows[queries], np.broadcast_to(rows, scores.shape)], axis=1)
+        if candidates.shape[1] > self.k:
+            best = np.argpartition(-candidates, self.k - 1, axis=1)[:, :self.k]
+            candidates = np.take_along_axis(candidates, best, axis=1)
+            candidate_rows = np.take_along_axis(candidate_rows, best, axis=1)
+        self.scores[queries] = candidates
+        self.rows[queries] = candidate_rows
+
+    def sorted(self):
+        order = np.argsort(-self.scores, axis=1)
+        return np.take_along_axis(self.scores, order, axis=1), np.take_along_axis(self.rows, order, axis=1)
+
+
+class LocalIndex:
+    # Memory mapped index: opening only maps the files, pages are read on first touch during search
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE), encoding="utf-8") as f:
+            self.info = json.load(f)
+        self.vectors = np.load(os.path.join(path, VECTORS_FILE), mmap_mode="r")
+        self.scales = np.load(os.path.join(path, SCALES_FILE), mmap_mode="r") if self.info["dtype"] == "int8" else None
+        self.centers = None
+        if self.info["ivf_lists"]:
+            self.centers = np.load(os.path.join(path, CENTROIDS_FILE))
+            self.list_offsets = np.load(os.path.join(path, LIST_OFFSETS_FILE))
+        self.metadata_offsets = np.load(os.path.join(path, METADATA_OFFSETS_FILE), mmap_mode="r")
+        self.metadata_file = open(os.path.join(path, METADATA_FILE), "rb")
+
+    def score(self, queries, start, end):
+        # Inner products of unit vectors = cosine similarity; one matrix product per block
+        block = self.vectors[start:end].astype(np.float32)
+        scores = queries @ block.T
+        if self.scales is not None:
+            scores *= self.scales[start:end]
+        return scores
+
+    def search_vectors(self, queries, k=10, nprobe=8, block_rows=65536):
+        # Batched top-k: (scores, rows) of shape (n_queries, k), rows -1 where fewer than k rows were scanned
+        queries = normalized(np.atleast_2d(queries))
+        top = TopK(len(queries), k)
+        if self.centers is None:
+            all_queries = np.arange(len(queries))
+            for start in range(0, len(self.vectors), block_rows):
+                end = min(start + block_rows, len(self.vectors))
+                top.merge(all_queries, self.score(queries, start, end), np.arange(start, end))
+            return top.sorted()
+        # Each inverted list is scanned once for all queries that probe it
+        nprobe = min(nprobe, len(self.centers))
+        probes = np.argpartition(-(queries @ self.centers.T), nprobe - 1, axis=1)[:, :nprobe]
+        for cluster in np.unique(probes):
+            probing = np.nonzero((probes == cluster).any(axis=1))[0]
+            list_start, list_end = int(self.list_offsets[cluster]), int(self.list_offsets[cluster + 1])
+            for start in range(list_start, list_end, block_rows):
+                end = min(start + block_rows, list_end)
+                top.merge(probing, self.score(queries[probing], start, end), np.arange(start, end))
+        return top.sorted()
+
+    def metadata(self, row):
+        self.metadata_file.seek(int(self.metadata_offsets[row]))
+        return json.loads(self.metadata_file.readline())
+
+    def search(self, queries, k=10, nprobe=8):
+        # Same result rows as search.SearchEngine: metadata plus cosine distance
+        scores, rows = self.search_vectors(queries, k, nprobe)
+        return [[dict(self.metadata(row), distance=float(1 - score)) for score, row in zip(query_scores, query_rows)
+                 if row >= 0] for query_scores, query_rows in zip(scores, rows)]
+
+    def close(self):
+        self.metadata_file.close()
@@ -1,12 +1,22 @@
 import argparse
 import os
 import sys
+import time
 
 from arguments import parse_args, get_env
 from pathlib import Path
-from convert_2_pdf import convert_files
-from pdf_2_text import files_text_from_directory, token_count, text_price
-from store_2_db import store_chunks, setup_database_and_table, create_index
+from convert_2_pdf import convert_files, output_pdf_name, classify_file
+from dedup import ChunkDeduplicator
+from estimate import estimate_tokens, print_estimate, write_estimate
+from jobs import (POLL_SECONDS, Heartbeat, claim_jobs, connect as jobs_connect, default_worker_id, enqueue_jobs,
+                  ensure_jobs_table, fail_jobs, failed_jobs, finish_jobs, job_counts, job_params, jobs_table,
+                  reclaim_stale_jobs)
+from journal import IngestJournal
+from manifest import load_manifest, save_manifest, scan_manifest
+from metrics import metrics
+from pdf_2_text import files_text_from_directory, pdf_files_in_directory, token_count, text_price
+from pipeline import pipeline_items
+from store_2_db import store_items, setup_database_and_table, create_index
 
 def is_directory_readable(directory):
     if len(os.listdir(directory)) == 0:
@@ -37,6 +47,137 @@ def is_directory_writable(directory_path):
         raise argparse.ArgumentTypeError(f"The directory '{directory_path}' does not exist.")
 
 
+def text_sources(root_dir, files):
+    # Text files skip the PDF conversion; they keep the document name the PDF would have had
+    return {output_pdf_name(f): os.path.join(root_dir, f) for f in files if classify_file(f) == "txt"}
+
+
+def report_metrics(args):
+    metrics.print_report()
+    prometheus_file = os.path.join(args.out_directory, args.prometheus_file) if args.prometheus_file else None
+    metrics.write(os.path.join(args.out_directory, args.metrics_file), prometheus_file)
+    if args.profile:
+        metrics.write_profiles(args.out_directory)
+
+
+def run_parameters(args, env_dict):
+    # Everything that changes the chunk keys or the stored vectors; a run is only resumed with the same values
+    return {"in_directory": os.path.abspath(args.in_directory), "table": env_dict["DB_TABLE_NAME"],
+            "embedding_model": args.embedding_model, "chunk_size": args.chunk_size,
+            "overlapping_size": args.overlapping_size, "dimensions": args.dimensions, "halfvec": args.halfvec}
+
+
+def distributed_parameters(args, env_dict):
+    # The settings every worker must share with the coordinator; the input directory may be mounted elsewhere
+    params = run_parameters(args, env_dict)
+    del params["in_directory"]
+    return params
+
+
+def coordinate(args, env_dict, infiles):
+    # Enqueues one job per input file, reclaims the jobs of dead workers and builds the index once all jobs
+    # are finished. Returns the exit status
+    setup_database_and_table(args.embedding_model, env_dict, args.dimensions, 'halfvec' if args.halfvec else 'vector',
+                             args.binary_column)
+    ensure_jobs_table(env_dict)
+    enqueued = enqueue_jobs(env_dict, args.in_directory, infiles, distributed_parameters(args, env_dict))
+    print(f"Enqueued {enqueued} of {len(infiles)} files, waiting for the workers")
+    table = jobs_table(env_dict)
+    conn = jobs_connect(env_dict)
+    while True:
+        reclaim_stale_jobs(conn, table, args.stale_seconds, args.max_attempts)
+        counts = job_counts(conn, table)
+        print(f"\rJobs: {counts['done']} done, {counts['running']} running, {counts['pending']} pending, "
+              f"{counts['failed']} failed", end="", flush=True)
+        if not counts["pending"] and not counts["running"]:
+            break
+        time.sleep(POLL_SECONDS)
+    print()
+    failed = failed_jobs(conn, table)
+    conn.close()
+    create_index(env_dict, args.index_type, args.index_memory_mb, args.index_workers, args.rebuild_index)
+    report_metrics(args)
+    for file, attempts, error in failed:
+        print(f"Failed after {attempts} attempts: {file}: {error}")
+    return 1 if failed else 0
+
+
+def work(args, env_dict):
+    # Claims a few files at a time and converts, chunks, embeds and stores them. The rows of the claimed
+    # files are replaced in one transaction, so a job reclaimed from a dead worker is simply done again
+    table = jobs_table(env_dict)
+    worker = args.worker_id or default_worker_id()
+    ensure_jobs_table(env_dict)
+    conn = jobs_connect(env_dict)
+    heartbeat = Heartbeat(env_dict, worker, args.heartbeat_seconds)
+    heartbeat.start()
+    print(f"Worker {worker} started")
+    verified = False
+    waiting = False
+    while True:
+        reclaim_stale_jobs(conn, table, args.stale_seconds, args.max_attempts)
+        # Nothing is claimed before the settings of the enqueued jobs are known to match
+        if not verified:
+            params = job_params(conn, table)
+            if params is not None:
+                if params != distributed_parameters(args, env_dict):
+                    raise ValueError(f"The coordinator enqueued the jobs with {params} - "
+                                     f"start the worker with the same settings")
+                verified = True
+        files = claim_jobs(conn, table, worker, args.claim_files) if verified else []
+        if not files:
+            counts = job_counts(conn, table)
+            if not any(counts.values()):
+                # A worker started before the coordinator waits for its jobs instead of finding nothing to do
+                if not waiting:
+                    print("Waiting for the coordinator to enqueue the jobs")
+                    waiting = True
+            elif not counts["pending"] and not counts["running"]:
+                break
+            time.sleep(POLL_SECONDS)
+            continue
+        heartbeat.files = files
+        claimed_pdfs = [output_pdf_name(f) for f in files if classify_file(f) != "txt"]
+        failed = convert_files(files, args.in_directory, args.out_directory, [], args.office_workers,
+                               args.office_timeout)
+        # A file that failed to convert keeps its rows and goes back to the queue
+        if failed:
+            fail_jobs(conn, table, worker, failed, f"conversion failed on worker {worker}, see its log",
+                      args.max_attempts)
+            files = [f for f in files if f not in failed]
+            heartbeat.files = files
+        pdf_names = [output_pdf_name(f) for f in files if classify_file(f) != "txt"]
+        if files:
+            unreadable = {}
+            items = pipeline_items(pdf_files_in_directory(args.out_directory, pdf_names),
+                                   text_sources(args.in_directory, files), args.chunk_size, args.overlapping_size,
+                                   args.embedding_model, args.overlapping_size + 1, args.extract_workers,
+                                   on_error=lambda name, error: unreadable.setdefault(name, error))
+            dedup = ChunkDeduplicator(args.dedup_threshold, args.skip_duplicates) if args.dedup_threshold is not None else None
+            stored = store_items(args.embedding_model, env_dict, items, args.parallel_requests, args.batch_size,
+                                 args.rpm, args.tpm, args.cache_file, args.cache_size_mb,
+                                 [output_pdf_name(f) for f in files], max_retries=args.max_retries, dedup=dedup)
+            if stored is None:
+                fail_jobs(conn, table, worker, files, f"storing failed on worker {worker}, see its log", args.max_attempts)
+            else:
+                # A file whose text could not be extracted fails alone
+                for f in [f for f in files if output_pdf_name(f) in unreadable]:
+                    fail_jobs(conn, table, worker, [f], f"text extraction failed: {unreadable[output_pdf_name(f)]}",
+                              args.max_attempts)
+                    files.remove(f)
+                if finish_jobs(conn, table, worker, files) < len(files):
+                    print(f"\nSome of {files} were reclaimed by another worker while stored here")
+        heartbeat.files = []
+        # The converted PDFs are only needed for this claim
+        for pdf in claimed_pdfs:
+            (Path(args.out_directory) / pdf).unlink(missing_ok=True)
+    heartbeat.stop()
+    conn.close()
+    report_metrics(args)
+    print(f"Worker {worker} finished, no jobs left")
+    return 0
+
+
 def list_files_in_directory(root_dir, extensions_string):
     extensions_list = [ext.strip() for ext in extensions_string.split(',')]
     root_path = Path(root_dir)
@@ -48,18 +189,89 @@ def list_files_in_directory(root_dir, extensions_string):
 if __name__ == '__main__':
     args = parse_args()
     env_dict = get_env()
+    if args.profile:
+        metrics.enable_profiling()
     is_directory_readable(args.in_directory)
     infiles = list_files_in_directory(args.in_directory, env_dict["FILE_FORMATS"])
     print(f"Number of infiles: {len(infiles)}")
     is_directory_writable(args.out_directory)
-    convert_files(infiles, args.in_directory, args.out_directory)
-    parsed = files_text_from_directory(args.out_directory, args.chunk_size, args.overlapping_size, args.embedding_model, args.overlapping_size + 1)
+    if args.estimate:
+        report = estimate_tokens(args.in_directory, infiles, args.embedding_model, args.chunk_size, args.overlapping_size,
+                                 args.extract_workers, args.sample_units or sys.maxsize)
+        print_estimate(report)
+        write_estimate(report, os.path.join(args.out_directory, args.estimate_file))
+        sys.exit()
+    if args.distributed == 'coordinator':
+        sys.exit(coordinate(args, env_dict, infiles))
+    if args.distributed == 'worker':
+        sys.exit(work(args, env_dict))
+    journal = IngestJournal(args.out_directory, run_parameters(args, env_dict), resume=True) if args.resume else None
+    replace_files = None
+    pdf_names = None
+    sources = infiles
+    if args.incremental:
+        manifest = load_manifest(args.out_directory)
+        changed, deleted, new_manifest = scan_manifest(args.in_directory, infiles, manifest)
+        print(f"Changed files: {len(changed)}, removed files: {len(deleted)}")
+        removed_pdfs = [entry["pdf"] for entry in deleted.values()]
+        failed_conversions = convert_files(changed, args.in_directory, args.out_directory, removed_pdfs,
+                                           args.office_workers, args.office_timeout)
+        # A file that failed to convert keeps its rows and its old manifest entry, so the next run retries it
+        for f in failed_conversions:
+            changed.remove(f)
+            if f in manifest:
+                new_manifest[f] = manifest[f]
+            else:
+                del new_manifest[f]
+        if failed_conversions:
+            print(f"{len(failed_conversions)} changed files failed to convert and are retried by the next run")
+        replace_files = [output_pdf_name(f) for f in changed] + removed_pdfs
+        pdf_names = [output_pdf_name(f) for f in changed if classify_file(f) != "txt"]
+        sources = changed
+    elif journal:
+        # Files an interrupted run stored completely are neither converted nor extracted again
+        sources = [f for f in infiles if output_pdf_name(f) not in journal.done]
+        pdf_names = [output_pdf_name(f) for f in sources if classify_file(f) != "txt"]
+        print(f"Files left to store: {len(sources)}")
+        convert_files(sources, args.in_directory, args.out_directory, [], args.office_workers, args.office_timeout)
+    else:
+        convert_files(infiles, args.in_directory, args.out_directory, None, args.office_workers, args.office_timeout)
+    text_files = text_sources(args.in_directory, sources)
     if args.token_count:
+        parsed = files_text_from_directory(args.out_directory, args.chunk_size, args.overlapping_size, args.embedding_model, args.overlapping_size + 1,
+                                           pdf_names, text_files, args.extract_workers)
         total_chunks = token_count(parsed)
         price = text_price(args.embedding_model, total_chunks)
         print(f"Total tokens {total_chunks} - price for {args.embedding_model}: {price} USD")
+        report_metrics(args)
         sys.exit()
-    setup_database_and_table(args.embedding_model, env_dict)
-    store_chunks(args.embedding_model,env_dict,parsed)
-    create_index(env_dict)
+    if journal is None:
+        journal = IngestJournal(args.out_directory, run_parameters(args, env_dict))
+    setup_database_and_table(args.embedding_model, env_dict, args.dimensions, 'halfvec' if args.halfvec else 'vector',
+                             args.binary_column)
+    # Extraction, chunking, embedding and the DB writes run concurrently with bounded queues in between
+    # A document that cannot be extracted fails alone, the run goes on with the next one
+    items = pipeline_items(pdf_files_in_directory(args.out_directory, pdf_names), text_files,
+                           args.chunk_size, args.overlapping_size, args.embedding_model, args.overlapping_size + 1,
+                           args.extract_workers, on_error=journal.document_failure)
+    # Duplicate chunks are found between chunking and embedding and get the vector of their first occurrence
+    dedup = ChunkDeduplicator(args.dedup_threshold, args.skip_duplicates) if args.dedup_threshold is not None else None
+    stored = store_items(args.embedding_model, env_dict, items, args.parallel_requests, args.batch_size, args.rpm, args.tpm,
+                         args.cache_file, args.cache_size_mb, replace_files, journal, args.max_retries, dedup)
+    if stored is None:
+        report_metrics(args)
+        journal.report()
+        sys.exit(1)
+    # The manifest is only written after the rows are committed, so a failed run is simply repeated.
+    # Files with failed chunks are left out, so the next incremental run retries them
+    failed_files = journal.failed_file_names()
+    if args.incremental:
+        new_manifest = {f: entry for f, entry in new_manifest.items() if entry["pdf"] not in failed_files}
+        save_manifest(args.out_directory, new_manifest)
+    create_index(env_dict, args.index_type, args.index_memory_mb, args.index_workers, args.rebuild_index)
+    report_metrics(args)
+    journal.report()
+    journal.close()
+    if failed_files:
+        sys.exit(1)
     print(f'Embeddings successfully saved')
@@ -0,0 +1,51 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+from convert_2_pdf import output_pdf_name
+
+MANIFEST_FILE = ".manifest.json"
+
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def load_manifest(out_directory):
+    path = Path(out_directory) / MANIFEST_FILE
+    if not path.exists():
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(out_directory, manifest):
+    path = Path(out_directory) / MANIFEST_FILE
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+
+
+def scan_manifest(in_directory, files, manifest):
+    # Returns (changed files, deleted manifest entries, new manifest); content is hashed only if size or mtime moved
+    changed = []
+    new_manifest = {}
+    for file in files:
+        stat = os.stat(os.path.join(in_directory, file))
+        old = manifest.get(file)
+        entry = {"size": stat.st_size, "mtime": stat.st_mtime, "pdf": output_pdf_name(file)}
+        if old and old["size"] == entry["size"] and old["mtime"] == entry["mtime"]:
+            entry["sha256"] = old["sha256"]
+        else:
+            entry["sha256"] = file_hash(os.path.join(in_directory, file))
+            if not old or old["sha256"] != entry["sha256"]:
+                changed.append(file)
+        new_manifest[file] = entry
+    deleted = {file: entry for file, entry in manifest.items() if file not in new_manifest}
+    return changed, deleted, new_manifest
@@ -0,0 +1,253 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# resource is Unix only; without it the report has no peak RSS
+try:
+    import resource
+except ImportError:
+    resource = None
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def peak_rss_mb():
+    # Peak resident set size of this process and of the largest child (extraction workers, LibreOffice)
+    if resource is None:
+        return None, None
+    divisor = 1024 * 1024 if sys.platform == "darwin" else 1024  # ru_maxrss is bytes on macOS, KB on Linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / divisor
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / divisor
+    return round(own, 1), round(children, 1)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-quantile
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            seen += count
+            if seen >= target:
+                return bound if bound != float("inf") else self.max
+        return self.max
+
+
+class StageStats:
+    def __init__(self):
+        self.calls = 0
+        self.busy_seconds = 0.0
+        self.items = 0
+        self.tokens = 0
+        self.first_start = None
+        self.last_end = None
+
+
+class ProfileStats:
+    # cProfile stats taken in another process, in the form pstats loads them
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def has_stats(profile):
+    # pstats refuses a profile that recorded nothing, e.g. a worker that never ran a task
+    profile.create_stats()
+    return bool(profile.stats)
+
+
+class Metrics:
+    # Run wide, thread safe collection of stage timings, counters and latency histograms.
+    # Stages overlap in the pipeline, so each stage reports its busy time (summed over threads and
+    # workers) and its wall span from the first start to the last end.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+        self.histograms = {}
+        self.profiles = None
+
+    def enable_profiling(self):
+        self.profiles = {}
+
+    def record(self, name, seconds, items=0, tokens=0, start=None):
+        end = time.time()
+        start = end - seconds if start is None else start
+        with self.lock:
+            stats = self.stages.setdefault(name, StageStats())
+            stats.calls += 1
+            stats.busy_seconds += seconds
+            stats.items += items
+            stats.tokens += tokens
+            stats.first_start = start if stats.first_start is None else min(stats.first_start, start)
+            stats.last_end = end if stats.last_end is None else max(stats.last_end, end)
+
+    def count(self, name, items=0, tokens=0):
+        with self.lock:
+            stats = self.stages.setdefault(name, StageStats())
+            stats.items += items
+            stats.tokens += tokens
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_profile(self, name, stats):
+        # Stats of a profile of the stage taken in a worker process
+        with self.lock:
+            self.profiles.setdefault(name, []).append(ProfileStats(stats))
+
+    def observe(self, name, seconds):
+        with self.lock:
+            self.histograms.setdefault(name, Histogram()).observe(seconds)
+
+    @contextmanager
+    def stage(self, name, items=0, tokens=0):
+        # Times the block as one call of the stage; with profiling on, the outermost stage of each
+        # thread is run under the thread's own cProfile of that stage (a profiler must not be shared by threads)
+        profile = None
+        if self.profiles is not None and not getattr(self.local, "profiling", False):
+            if not hasattr(self.local, "profiles"):
+                self.local.profiles = {}
+            profile = self.local.profiles.get(name) or cProfile.Profile()
+            try:
+                profile.enable()
+                self.local.profiling = True
+            except ValueError:  # another profiler is active (Python 3.12+ allows one per process)
+                profile = None
+            if profile is not None and name not in self.local.profiles:
+                # Registered only once it ran, a profiler that never started has no stats to merge
+                self.local.profiles[name] = profile
+                with self.lock:
+                    self.profiles.setdefault(name, []).append(profile)
+        start = time.time()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                self.local.profiling = False
+            self.record(name, time.perf_counter() - started, items, tokens, start)
+
+    def report(self):
+        own_rss, children_rss = peak_rss_mb()
+        with self.lock:
+            stages = {}
+            for name, stats in self.stages.items():
+                wall = (stats.last_end - stats.first_start) if stats.first_start is not None else 0.0
+                stages[name] = {
+                    "calls": stats.calls,
+                    "busy_seconds": round(stats.busy_seconds, 3),
+                    "wall_seconds": round(wall, 3),
+                    "items": stats.items,
+                    "tokens": stats.tokens,
+                    "items_per_second": round(stats.items / wall, 2) if wall else None,
+                    "tokens_per_second": round(stats.tokens / wall, 2) if wall else None,
+                }
+            histograms = {name: {"count": h.count, "sum": round(h.sum, 3), "max": round(h.max, 3),
+                                 "p50": h.quantile(0.5), "p95": h.quantile(0.95), "p99": h.quantile(0.99),
+                                 "buckets": dict(zip([str(b) for b in h.buckets] + ["+Inf"], h.counts))}
+                          for name, h in self.histograms.items()}
+            return {
+                "started": self.started,
+                "wall_seconds": round(time.time() - self.started, 3),
+                "peak_rss_mb": own_rss,
+                "peak_child_rss_mb": children_rss,
+                "stages": stages,
+                "counters": dict(self.counters),
+                "histograms": histograms,
+            }
+
+    def prometheus(self):
+        # Text exposition format, for the node exporter textfile collector or a push gateway
+        report = self.report()
+        lines = ["# TYPE vectorizer_run_seconds gauge", f"vectorizer_run_seconds {report['wall_seconds']}"]
+        if report["peak_rss_mb"] is not None:
+            lines += ["# TYPE vectorizer_peak_rss_bytes gauge",
+                      f"vectorizer_peak_rss_bytes {int(report['peak_rss_mb'] * 1024 * 1024)}",
+                      "# TYPE vectorizer_peak_child_rss_bytes gauge",
+                      f"vectorizer_peak_child_rss_bytes {int(report['peak_child_rss_mb'] * 1024 * 1024)}"]
+        for metric in ("busy_seconds", "wall_seconds", "items", "tokens"):
+            lines.append(f"# TYPE vectorizer_stage_{metric} gauge")
+            for name, stage in report["stages"].items():
+                lines.append(f'vectorizer_stage_{metric}{{stage="{name}"}} {stage[metric]}')
+        for name, value in report["counters"].items():
+            lines += [f"# TYPE vectorizer_{name}_total counter", f"vectorizer_{name}_total {value}"]
+        with self.lock:
+            for name, h in self.histograms.items():
+                lines.append(f"# TYPE vectorizer_{name}_seconds histogram")
+                cumulative = 0
+                for bound, count in zip(h.buckets + ("+Inf",), h.counts):
+                    cumulative += count
+                    lines.append(f'vectorizer_{name}_seconds_bucket{{le="{bound}"}} {cumulative}')
+                lines += [f"vectorizer_{name}_seconds_sum {h.sum}", f"vectorizer_{name}_seconds_count {h.count}"]
+        return "\n".join(lines) + "\n"
+
+    def print_report(self):
+        report = self.report()
+        print(f"{'stage':<12} {'calls':>7} {'busy [s]':>10} {'wall [s]':>10} {'items':>9} {'items/s':>9} {'tokens/s':>10}")
+        for name, stage in report["stages"].items():
+            print(f"{name:<12} {stage['calls']:>7} {stage['busy_seconds']:>10.2f} {stage['wall_seconds']:>10.2f} "
+                  f"{stage['items']:>9} {stage['items_per_second'] or 0:>9.1f} {stage['tokens_per_second'] or 0:>10.1f}")
+        for name, h in report["histograms"].items():
+            print(f"{name}: {h['count']} calls, p50 <= {h['p50']}s, p95 <= {h['p95']}s, max {h['max']}s")
+        for name, value in report["counters"].items():
+            print(f"{name}: {value}")
+        print(f"Total {report['wall_seconds']:.1f}s, peak RSS {report['peak_rss_mb']} MB "
+              f"(largest child {report['peak_child_rss_mb']} MB)")
+
+    def write(self, path, prometheus_path=None):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, indent=2)
+        print(f"Run metrics written to {path}")
+        if prometheus_path:
+            with open(prometheus_path, "w", encoding="utf-8") as f:
+                f.write(self.prometheus())
+            print(f"Prometheus metrics written to {prometheus_path}")
+
+    def write_profiles(self, directory, top=15):
+        # One .prof file per stage (snakeviz / pstats), merged over its threads and worker processes,
+        # and the top functions by cumulative time
+        for name, profiles in (self.profiles or {}).items():
+            profiles = [profile for profile in profiles if has_stats(profile)]
+            if not profiles:
+                continue
+            path = os.path.join(directory, f"profile_{name}.prof")
+            out = io.StringIO()
+            stats = pstats.Stats(*profiles, stream=out)
+            stats.dump_stats(path)
+            stats.sort_stats("cumulative").print_stats(top)
+            print(f"Profile of stage {name} written to {path}")
+            print(out.getvalue())
+
+
+metrics = Metrics()
@@ -0,0 +1,232 @@
+import os
+import queue
+import shutil
+import signal
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+# UNO is only importable with the LibreOffice bundled python (python3-uno). Without it every worker keeps
+# a long lived unoserver (installed with the python that has uno) and converts through unoconvert; with
+# neither, every document starts its own soffice and the pool saves nothing but the profile set-up
+try:
+    import uno
+    from com.sun.star.beans import PropertyValue
+except ImportError:
+    uno = None
+
+OFFICE_BINARY = "libreoffice"
+UNOSERVER = shutil.which("unoserver") and shutil.which("unoconvert")
+
+pdf_filters = {
+    ".doc": "writer_pdf_Export", ".docx": "writer_pdf_Export", ".odt": "writer_pdf_Export",
+    ".xls": "calc_pdf_Export", ".xlsx": "calc_pdf_Export",
+    ".ppt": "impress_pdf_Export", ".pptx": "impress_pdf_Export",
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def kill_process_group(process):
+    # soffice forks soffice.bin, so the whole session has to go
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+    process.wait()
+
+
+def uno_property(name, value):
+    prop = PropertyValue()
+    prop.Name = name
+    prop.Value = value
+    return prop
+
+
+class OfficeWorker:
+    def __init__(self, worker_id, timeout):
+        self.worker_id = worker_id
+        self.timeout = timeout
+        self.profile_dir = tempfile.mkdtemp(prefix=f"lo_profile_{worker_id}_")
+        self.profile_url = Path(self.profile_dir).as_uri()
+        self.process = None
+        self.desktop = None
+        self.port = None
+
+    def start(self):
+        if uno is None:
+            return self.start_unoserver()
+        port = free_port()
+        self.process = subprocess.Popen(
+            [OFFICE_BINARY, "--headless", "--invisible", "--nologo", "--norestore", "--nodefault",
+             f"-env:UserInstallation={self.profile_url}",
+             f"--accept=socket,host=127.0.0.1,port={port};urp;StarOffice.ComponentContext"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+        local_context = uno.getComponentContext()
+        resolver = local_context.ServiceManager.createInstanceWithContext(
+            "com.sun.star.bridge.UnoUrlResolver", local_context)
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                context = resolver.resolve(f"uno:socket,host=127.0.0.1,port={port};urp;StarOffice.ComponentContext")
+                break
+            except Exception:
+                if time.monotonic() > deadline or self.process.poll() is not None:
+                    self.stop()
+                    raise RuntimeError(f"LibreOffice worker {self.worker_id} did not start")
+                time.sleep(0.5)
+        self.desktop = context.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", context)
+        print(f"LibreOffice worker {self.worker_id} started (pid {self.process.pid})")
+
+    def start_unoserver(self):
+        self.port = free_port()
+        self.process = subprocess.Popen(
+            ["unoserver", "--interface", "127.0.0.1", "--port", str(self.port), "--uno-port", str(free_port()),
+             "--user-installation", self.profile_url],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline or self.process.poll() is not None:
+                    self.stop()
+                    raise RuntimeError(f"unoserver worker {self.worker_id} did not start")
+                time.sleep(0.5)
+        print(f"unoserver worker {self.worker_id} started (pid {self.process.pid})")
+
+    def stop(self):
+        if self.process is not None:
+            kill_process_group(self.process)
+        self.process = None
+        self.desktop = None
+        self.port = None
+
+    def restart(self):
+        print(f"Restarting LibreOffice worker {self.worker_id}")
+        self.stop()
+        self.start()
+
+    def convert(self, input_file, output_pdf):
+        # Only a timeout or a dead office process recycles the worker; a document LibreOffice cannot
+        # convert fails on its own
+        if uno is None and not UNOSERVER:
+            return self.convert_cli(input_file, output_pdf)
+        if self.process is None:
+            self.start()
+        elif self.process.poll() is not None:
+            self.restart()
+        if uno is None:
+            return self.convert_unoconvert(input_file, output_pdf)
+        # Watchdog - killing the office process makes the blocked UNO call fail
+        timed_out = threading.Event()
+
+        def on_timeout():
+            timed_out.set()
+            kill_process_group(self.process)
+
+        watchdog = threading.Timer(self.timeout, on_timeout)
+        watchdog.start()
+        try:
+            self.convert_uno(input_file, output_pdf)
+        except Exception as e:
+            if timed_out.is_set():
+                self.stop()
+                raise TimeoutError(f"Conversion of {input_file} exceeded {self.timeout}s")
+            if self.process.poll() is not None:
+                self.stop()
+                raise RuntimeError(f"LibreOffice worker {self.worker_id} died on {input_file}: {e}")
+            raise
+        finally:
+            watchdog.cancel()
+
+    def convert_uno(self, input_file, output_pdf):
+        doc = self.desktop.loadComponentFromURL(Path(input_file).resolve().as_uri(), "_blank", 0,
+                                                (uno_property("Hidden", True),))
+        if doc is None:
+            raise RuntimeError(f"LibreOffice cannot load {input_file}")
+        try:
+            pdf_filter = pdf_filters.get(Path(input_file).suffix.lower(), "writer_pdf_Export")
+            doc.storeToURL(Path(output_pdf).resolve().as_uri(), (uno_property("FilterName", pdf_filter),))
+        finally:
+            doc.close(True)
+
+    def convert_unoconvert(self, input_file, output_pdf):
+        try:
+            result = subprocess.run(
+                ["unoconvert", "--host", "127.0.0.1", "--port", str(self.port), "--convert-to", "pdf",
+                 str(Path(input_file).resolve()), str(Path(output_pdf).resolve())],
+                capture_output=True, text=True, timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            self.stop()
+            raise TimeoutError(f"Conversion of {input_file} exceeded {self.timeout}s")
+        if result.returncode != 0:
+            error = result.stderr.strip().splitlines()[-1:] or [f"exit status {result.returncode}"]
+            if self.process.poll() is not None:
+                self.stop()
+                raise RuntimeError(f"unoserver worker {self.worker_id} died on {input_file}: {error[0]}")
+            raise RuntimeError(f"unoconvert failed on {input_file}: {error[0]}")
+
+    def convert_cli(self, input_file, output_pdf):
+        out_dir = tempfile.mkdtemp(prefix=f"lo_out_{self.worker_id}_")
+        try:
+            self.process = subprocess.Popen(
+                [OFFICE_BINARY, "--headless", "--norestore", f"-env:UserInstallation={self.profile_url}",
+                 "--convert-to", "pdf", input_file, "--outdir", out_dir],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+            try:
+                self.process.wait(timeout=self.timeout)
+            except subprocess.TimeoutExpired:
+                raise TimeoutError(f"Conversion of {input_file} exceeded {self.timeout}s")
+            finally:
+                kill_process_group(self.process)
+                self.process = None
+            produced = Path(out_dir) / f"{Path(input_file).stem}.pdf"
+            if not produced.exists():
+                raise RuntimeError(f"LibreOffice produced no PDF for {input_file}")
+            shutil.move(str(produced), output_pdf)
+        finally:
+            shutil.rmtree(out_dir, ignore_errors=True)
+
+    def close(self):
+        self.stop()
+        shutil.rmtree(self.profile_dir, ignore_errors=True)
+
+
+class OfficePool:
+    # N long lived headless LibreOffice instances, each with its own user profile
+    def __init__(self, workers=4, timeout=300):
+        self.workers = [OfficeWorker(i, timeout) for i in range(workers)]
+        self.idle = queue.Queue()
+        self.warned = False
+        for worker in self.workers:
+            self.idle.put(worker)
+
+    def convert(self, input_file, output_pdf):
+        if uno is None and not UNOSERVER and not self.warned:
+            self.warned = True
+            print("WARNING: neither the LibreOffice python bindings (uno) nor unoserver are available - every "
+                  "office document starts its own LibreOffice, the pool gives no speedup")
+        worker = self.idle.get()
+        try:
+            worker.convert(input_file, output_pdf)
+        finally:
+            self.idle.put(worker)
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
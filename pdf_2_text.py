@@ -1,7 +1,21 @@
+import cProfile
 import fitz
+import numpy as np
 import tiktoken
 import os
+import multiprocessing
+import time
 from pathlib import Path
+from bisect import bisect_left, bisect_right
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from itertools import islice
+from convert_2_pdf import TEXT_LINES_PER_PAGE
+from metrics import metrics
+
+WHITESPACE = (b' ', b'\n')
 
 prices = {"text-embedding-3-small": 0.02, "text-embedding-3-large": 0.13, "text-embedding-ada-002": 0.1}
 
@@ -14,6 +28,25 @@ def extract_text(pdf):
             page_nr = page_nr + 1
     return result
 
+def pdf_page_count(pdf):
+    with fitz.open(pdf) as doc:
+        return doc.page_count
+
+def extract_page_range(pdf, start, end):
+    with fitz.open(pdf) as doc:
+        return [doc[page_nr].get_text() for page_nr in range(start, end)]
+
+def extract_text_file(text_file):
+    # Synthetic pages with the line geometry text_to_pdf used, read line by line without a PDF round trip
+    result = []
+    with open(text_file, 'r', encoding='utf-8') as file:
+        while True:
+            lines = list(islice(file, TEXT_LINES_PER_PAGE))
+            if not lines:
+                break
+            result.append("".join(f"{line.strip()}\n" for line in lines if line.strip()))
+    return result
+
 def token_count(parsed_files):
     print("Counting tokens:", end='', flush=True)
     total = 0
@@ -25,14 +58,117 @@ def token_count(parsed_files):
     print("\n")
     return total
 
-def files_text_from_directory(root_dir, chunk_size, overlap, model_name, min_chunk_size=3):
+def pdf_files_in_directory(root_dir, pdf_names=None):
     r_dir = Path(root_dir)
-    pdf_files = list(r_dir.glob('*.pdf'))
+    if pdf_names is None:
+        return list(r_dir.glob('*.pdf'))
+    return [r_dir / name for name in pdf_names if (r_dir / name).is_file()]
+
+def document_sources(pdf_files, text_files):
+    # (document name, path, extractor) for converted PDFs and directly read text files
+    for pdf in pdf_files:
+        yield os.path.basename(pdf), pdf, extract_text
+    for name, text_file in (text_files or {}).items():
+        yield name, text_file, extract_text_file
+
+def timed_task(function, *args, profile=False):
+    # Runs in the worker process, which has no metrics of its own - the time, and with profile the
+    # cProfile stats, travel back with the result
+    profiler = cProfile.Profile() if profile else None
+    start = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    try:
+        result = function(*args)
+    finally:
+        if profiler:
+            profiler.disable()
+    seconds = time.perf_counter() - start
+    if profiler:
+        profiler.create_stats()
+        return result, seconds, profiler.stats
+    return result, seconds, None
+
+def collect_pages(tasks):
+    pages = []
+    for task in tasks:
+        task_pages, seconds, stats = task.result()
+        metrics.record("extract", seconds, len(task_pages))
+        if stats:
+            metrics.add_profile("extract", stats)
+        pages += task_pages
+    return pages
+
+def extract_documents(sources, workers=None, pages_per_task=100, stop=None, on_error=None):
+    # Yields (name, pages) in source order. Extraction runs in a process pool; large PDFs are split
+    # into page ranges so one huge document is spread over all workers. At most 2 tasks per worker
+    # are queued ahead of the consumer. Setting stop, or closing the generator, cancels the queued tasks.
+    # A document that cannot be read is passed to on_error(name, error) and skipped, without
+    # on_error the error ends the extraction. A broken pool is never a problem of one document.
+    workers = workers or os.cpu_count()
+    profile = metrics.profiles is not None
+    pending = deque()
+    in_flight = 0
+
+    def failed(name, error):
+        if on_error is None or isinstance(error, BrokenProcessPool):
+            raise error
+        on_error(name, error)
+
+    def collected(name, tasks):
+        try:
+            return collect_pages(tasks)
+        except Exception as e:
+            for task in tasks:
+                task.cancel()
+            failed(name, e)
+            return None
+
+    # spawn - the pipeline threads are already running, forking them is not safe
+    executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        for name, path, extractor in sources:
+            if stop is not None and stop.is_set():
+                return
+            if extractor is extract_text:
+                try:
+                    page_count = pdf_page_count(path)
+                except Exception as e:
+                    failed(name, e)
+                    continue
+                tasks = [executor.submit(timed_task, extract_page_range, path, start,
+                                         min(start + pages_per_task, page_count), profile=profile)
+                         for start in range(0, page_count, pages_per_task)]
+            else:
+                tasks = [executor.submit(timed_task, extractor, path, profile=profile)]
+            pending.append((name, tasks))
+            in_flight += len(tasks)
+            while in_flight > 2 * workers:
+                name, tasks = pending.popleft()
+                in_flight -= len(tasks)
+                pages = collected(name, tasks)
+                if pages is not None:
+                    yield name, pages
+        while pending:
+            if stop is not None and stop.is_set():
+                return
+            name, tasks = pending.popleft()
+            pages = collected(name, tasks)
+            if pages is not None:
+                yield name, pages
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def skipped_document(name, error):
+    print(f"\nSkipping {name}, its text cannot be extracted: {error}")
+
+def files_text_from_directory(root_dir, chunk_size, overlap, model_name, min_chunk_size=3, pdf_names=None, text_files=None,
+                              workers=None):
+    # text_files maps document names to text files in the input directory which are read directly
     result = {}
-    for f in pdf_files:
-        pages = extract_text(f)
-        chunks = split_text_into_chunks(pages, chunk_size, overlap, model_name, min_chunk_size)
-        result[os.path.basename(f)] = chunks
+    sources = document_sources(pdf_files_in_directory(root_dir, pdf_names), text_files)
+    for name, pages in extract_documents(sources, workers, on_error=skipped_document):
+        result[name] = timed_split_text_into_chunks(pages, chunk_size, overlap, model_name, min_chunk_size)
 
     return result
 
@@ -42,53 +178,105 @@ def text_price(model, tokens):
             return round(prices[key] * (tokens / 1000000), 2)
     return 0
 
+@lru_cache(maxsize=None)
+def get_encoding(model_name):
+    return tiktoken.encoding_for_model(model_name)
+
+@lru_cache(maxsize=None)
+def token_table(encoding):
+    # Byte length and whitespace flags of every token of the vocabulary
+    size = encoding.max_token_value + 1
+    lengths = np.zeros(size, dtype=np.int64)
+    starts_ws = np.zeros(size, dtype=bool)
+    ends_ws = np.zeros(size, dtype=bool)
+    for token in range(size):
+        try:
+            token_bytes = encoding.decode_single_token_bytes(token)
+        except KeyError:
+            continue
+        lengths[token] = len(token_bytes)
+        starts_ws[token] = token_bytes[:1] in WHITESPACE
+        ends_ws[token] = token_bytes[-1:] in WHITESPACE
+    return lengths, starts_ws, ends_ws
+
+class PageTokens:
+    # Tokens of one page with their bytes decoded once and a boundary index of whitespace edges
+    def __init__(self, encoding, tokens):
+        self.encoding = encoding
+        self.table = token_table(encoding)
+        self.tokens = []
+        self.data = bytearray()
+        self.offsets = [0]
+        self.starts = []  # indexes of tokens starting with ' ' or '\n'
+        self.ends = []    # indexes of tokens ending with ' ' or '\n'
+        self.extend(tokens)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def extend(self, tokens):
+        lengths, starts_ws, ends_ws = self.table
+        ids = np.asarray(tokens, dtype=np.int64)
+        base = len(self.tokens)
+        self.starts += (np.flatnonzero(starts_ws[ids]) + base).tolist()
+        self.ends += (np.flatnonzero(ends_ws[ids]) + base).tolist()
+        self.offsets += (np.cumsum(lengths[ids]) + len(self.data)).tolist()
+        self.data += self.encoding.decode_bytes(tokens)
+        self.tokens += tokens
+
+    def next_end(self, end_idx):
+        # First end_idx' >= end_idx such that the chunk ends with whitespace or the page ends
+        i = bisect_left(self.ends, end_idx - 1)
+        return min(self.ends[i] + 1, len(self.tokens)) if i < len(self.ends) else len(self.tokens)
+
+    def prev_start(self, token_idx):
+        # Last token_idx' <= token_idx whose token starts with whitespace, or 0
+        i = bisect_right(self.starts, token_idx)
+        return self.starts[i - 1] if i else 0
+
+    def decode(self, start, end):
+        return self.data[self.offsets[start]:self.offsets[end]].decode("utf-8", errors="replace")
+
 def split_text_into_chunks(pages, chunk_size, overlap, model_name, min_chunk_size=3):
+    # Chunks never start or end inside a word: the end is moved forward to a token ending with
+    # whitespace and the start back to a token starting with whitespace. A chunk running over the
+    # end of a page borrows the missing tokens from the next page.
     result = {}
 
-    encoding = tiktoken.encoding_for_model(model_name)
+    encoding = get_encoding(model_name)
     all_tokens = [encoding.encode(page_text) for page_text in pages]
 
-    page_num = 1
-    chunk_num = 1
-    token_idx = 0
-
-    while page_num <= len(all_tokens):
-        tokens = all_tokens[page_num - 1]
+    for page_num in range(1, len(all_tokens) + 1):
+        page = PageTokens(encoding, all_tokens[page_num - 1])
+        chunk_num = 1
+        token_idx = 0
 
-        while token_idx < len(tokens):
+        while token_idx < len(page):
             end_idx = token_idx + chunk_size
 
-            if end_idx > len(tokens) and page_num < len(all_tokens):
-                next_tokens_needed = end_idx - len(tokens)
-                tokens += all_tokens[page_num][:next_tokens_needed]
+            if end_idx > len(page) and page_num < len(all_tokens):
+                next_tokens_needed = end_idx - len(page)
+                page.extend(all_tokens[page_num][:next_tokens_needed])
                 all_tokens[page_num] = all_tokens[page_num][next_tokens_needed:]
 
-            chunk_tokens = tokens[token_idx:end_idx]
-            chunk_text = encoding.decode(chunk_tokens)
-
-            while end_idx < len(tokens) and not chunk_text.endswith((' ', '\n')):
-                chunk_tokens.append(tokens[end_idx])
-                end_idx += 1
-                chunk_text = encoding.decode(chunk_tokens)
-
-            while token_idx > 0 and not encoding.decode([tokens[token_idx]]).startswith((' ', '\n')):
-                token_idx -= 1
-                chunk_tokens = tokens[token_idx:end_idx]
-                chunk_text = encoding.decode(chunk_tokens)
+            if end_idx < len(page):
+                end_idx = page.next_end(end_idx)
+            token_idx = page.prev_start(token_idx)
+            chunk_end = min(end_idx, len(page))
 
             chunk_key = f"{page_num}_{chunk_num}"
             result[chunk_key] = {
-                "text": chunk_text.strip(),
-                "length": len(chunk_tokens)
+                "text": page.decode(token_idx, chunk_end).strip(),
+                "length": chunk_end - token_idx
             }
 
             token_idx = end_idx - overlap
             chunk_num += 1
 
-        page_num += 1
-        chunk_num = 1
-        token_idx = 0
-
     return result
 
-
+def timed_split_text_into_chunks(pages, chunk_size, overlap, model_name, min_chunk_size=3):
+    with metrics.stage("chunk"):
+        chunks = split_text_into_chunks(pages, chunk_size, overlap, model_name, min_chunk_size)
+    metrics.count("chunk", len(chunks), sum(chunk["length"] for chunk in chunks.values()))
+    return chunks
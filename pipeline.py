@@ -0,0 +1,78 @@
+import queue
+import threading
+
+from pdf_2_text import document_sources, extract_documents, timed_split_text_into_chunks
+from store_2_db import chunk_items
+
+DONE = object()
+
+
+class Stage(threading.Thread):
+    # One pipeline stage in its own thread; an exception is handed over to the consumer
+    def __init__(self, target, out_q):
+        super().__init__(daemon=True)
+        self.target = target
+        self.out_q = out_q
+        self.error = None
+
+    def run(self):
+        try:
+            self.target(self.out_q)
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.out_q.put(DONE)
+
+
+def consume(in_q, stage):
+    while True:
+        item = in_q.get()
+        if item is DONE:
+            if stage.error:
+                raise stage.error
+            return
+        yield item
+
+
+def pipeline_items(pdf_files, text_files, chunk_size, overlap, model_name, min_chunk_size=3,
+                   extract_workers=None, max_documents=2, max_chunks=4096, on_error=None):
+    # extract -> chunk stages with bounded queues; yields chunk items for store_items (embed -> write).
+    # on_error(name, error) is called from the extract stage for a document whose text cannot be extracted
+    pages_q = queue.Queue(maxsize=max_documents)
+    chunks_q = queue.Queue(maxsize=max_chunks)
+    stop = threading.Event()
+
+    def extract(out_q):
+        for document in extract_documents(document_sources(pdf_files, text_files), extract_workers, stop=stop,
+                                          on_error=on_error):
+            if stop.is_set():
+                return
+            out_q.put(document)
+
+    def chunk(out_q):
+        for name, pages in consume(pages_q, extractor_stage):
+            if stop.is_set():
+                return
+            chunks = timed_split_text_into_chunks(pages, chunk_size, overlap, model_name, min_chunk_size)
+            for item in chunk_items({name: chunks}):
+                out_q.put(item)
+
+    extractor_stage = Stage(extract, pages_q)
+    chunker_stage = Stage(chunk, chunks_q)
+    extractor_stage.start()
+    chunker_stage.start()
+    try:
+        yield from consume(chunks_q, chunker_stage)
+    finally:
+        # A consumer that raised or stopped early ends both stages and the extraction processes; the
+        # queues are drained so a stage blocked on a full queue gets to see the stop
+        stop.set()
+        while extractor_stage.is_alive() or chunker_stage.is_alive():
+            for q in (pages_q, chunks_q):
+                while True:
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        break
+            extractor_stage.join(0.05)
+            chunker_stage.join(0.05)
@@ -0,0 +1,258 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+import numpy as np
+import uvicorn
+from openai import OpenAI
+from psycopg2.pool import ThreadedConnectionPool
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from arguments import get_env, parse_search_args
+from embeddings import request_dimensions
+from store_2_db import normalize_text
+from vector_index import embedding_column, BITS_COLUMN
+
+
+def vector_literal(emb):
+    return "[" + ",".join(f"{x:.7g}" for x in emb) + "]"
+
+
+class QueryEmbeddingCache:
+    # Thread safe LRU of query text -> embedding; repeated queries skip the API round trip
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, text):
+        with self.lock:
+            emb = self.entries.get(text)
+            if emb is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(text)
+            self.hits += 1
+            return emb
+
+    def put(self, text, emb):
+        with self.lock:
+            self.entries[text] = emb
+            self.entries.move_to_end(text)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class PooledCursor:
+    # Borrows a connection for one read only unit of work and returns it rolled back. The pool raises
+    # instead of waiting when it is empty, so a slot of the semaphore is taken first
+    def __init__(self, pool, slots):
+        self.pool = pool
+        self.slots = slots
+        self.conn = None
+        self.cursor = None
+
+    def __enter__(self):
+        self.slots.acquire()
+        try:
+            self.conn = self.pool.getconn()
+            self.cursor = self.conn.cursor()
+        except BaseException:
+            if self.conn is not None:
+                self.pool.putconn(self.conn)
+            self.slots.release()
+            raise
+        return self.cursor
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.cursor.close()
+            if not self.conn.closed:
+                self.conn.rollback()
+        finally:
+            self.pool.putconn(self.conn, close=bool(self.conn.closed))
+            self.slots.release()
+
+
+class SearchEngine:
+    # Similarity search over the stored chunks with pooled connections and cached query embeddings
+    def __init__(self, env_dict, client, model, pool_size=8, cache_entries=4096, probes=None, ef_search=None):
+        self.client = client
+        self.model = model
+        self.table_name = env_dict['DB_TABLE_NAME']
+        self.probes = probes
+        self.ef_search = ef_search
+        self.cache = QueryEmbeddingCache(cache_entries)
+        self.slots = threading.BoundedSemaphore(pool_size)
+        self.pool = ThreadedConnectionPool(1, pool_size, dbname=env_dict['DB_NAME'], user=env_dict['DB_USER'],
+                                           password=env_dict['DB_PASSWORD'], host=env_dict['DB_HOST'],
+                                           port=env_dict['DB_PORT'])
+        with self.connection() as cursor:
+            cursor.execute("""
+                SELECT 1 FROM information_schema.columns WHERE table_name = %s AND column_name = 'cluster_id';
+            """, (self.table_name,))
+            self.has_clusters = cursor.fetchone() is not None
+            self.vector_type, self.dim, self.has_bits = embedding_column(cursor, self.table_name)
+        # Query vectors are requested in the size the table stores
+        self.dimensions = request_dimensions(model, self.dim)
+
+    def connection(self):
+        return PooledCursor(self.pool, self.slots)
+
+    def embed_queries(self, queries):
+        # Queries are normalized like the stored chunks; all cache misses go in one request
+        texts = [normalize_text(query).strip() for query in queries]
+        embeddings = [self.cache.get(text) for text in texts]
+        misses = list(dict.fromkeys(text for text, emb in zip(texts, embeddings) if emb is None))
+        if misses:
+            options = {"dimensions": self.dimensions} if self.dimensions else {}
+            response = self.client.embeddings.create(input=misses, model=self.model, **options)
+            fetched = {text: np.asarray(data.embedding, dtype=np.float32) for text, data in zip(misses, response.data)}
+            for text, emb in fetched.items():
+                self.cache.put(text, emb)
+            embeddings = [emb if emb is not None else fetched[text] for text, emb in zip(texts, embeddings)]
+        return embeddings
+
+    def query(self, cursor, emb, k=10, probes=None, ef_search=None, files=None, clusters=None, exact=False,
+              candidates=None):
+        # Settings are transaction local, every pooled connection starts from the server defaults.
+        # candidates: number of rows pre-selected by Hamming distance on the binary column, re-ranked by cosine.
+        if candidates and not self.has_bits:
+            raise ValueError(f"Table {self.table_name} has no binary column, create it with --binary_column")
+        probes = probes or self.probes
+        # The index scan of the pre-filter has to return all candidates
+        ef_search = ef_search or self.ef_search or (min(max(int(candidates), 40), 1000) if candidates else None)
+        if probes:
+            cursor.execute("SELECT set_config('ivfflat.probes', %s, true);", (str(int(probes)),))
+        if ef_search:
+            cursor.execute("SELECT set_config('hnsw.ef_search', %s, true);", (str(int(ef_search)),))
+        if exact:
+            cursor.execute("SET LOCAL enable_indexscan = off;")
+        conditions = ["embedding IS NOT NULL"]
+        params = []
+        if files:
+            conditions.append("file = ANY(%s)")
+            params.append(list(files))
+        if clusters:
+            if not self.has_clusters:
+                raise ValueError(f"Table {self.table_name} has no clusters, run clustering.py first")
+            conditions.append("cluster_id = ANY(%s)")
+            params.append([int(cluster) for cluster in clusters])
+            # Filtered HNSW / IVFFlat scans keep going until k rows pass the filter (pgvector 0.8+)
+            cursor.execute("SELECT set_config('hnsw.iterative_scan', 'relaxed_order', true);")
+            cursor.execute("SELECT set_config('ivfflat.iterative_scan', 'relaxed_order', true);")
+        cluster_column = "cluster_id, cluster" if self.has_clusters else "NULL, NULL"
+        vector = vector_literal(emb)
+        source = self.table_name
+        if candidates:
+            source = f"""(
+                SELECT * FROM {self.table_name} WHERE {" AND ".join(conditions)}
+                ORDER BY {BITS_COLUMN} <~> binary_quantize(%s::{self.vector_type})::bit({self.dim})
+                LIMIT %s
+            ) candidates"""
+            params = params + [vector, int(candidates)]
+            conditions = ["TRUE"]
+        cursor.execute(f"""
+            SELECT id, file, page, position, text_chunk, {cluster_column}, embedding <=> %s::{self.vector_type} AS distance
+            FROM {source}
+            WHERE {" AND ".join(conditions)}
+            ORDER BY embedding <=> %s::{self.vector_type}
+            LIMIT %s;
+        """, [vector] + params + [vector, int(k)])
+        return [{"id": str(row[0]), "file": row[1], "page": row[2], "position": row[3], "text": row[4],
+                 "cluster_id": row[5], "cluster": row[6], "distance": float(row[7])}
+                for row in cursor.fetchall()]
+
+    def search(self, query, k=10, **options):
+        return self.search_batch([query], k, **options)[0]
+
+    def search_batch(self, queries, k=10, **options):
+        embeddings = self.embed_queries(queries)
+        with self.connection() as cursor:
+            results = []
+            for emb in embeddings:
+                results.append(self.query(cursor, emb, k, **options))
+                # Ends the transaction so SET LOCAL settings do not leak to the next query
+                cursor.connection.rollback()
+            return results
+
+    def close(self):
+        self.pool.closeall()
+
+
+def search_options(body):
+    options = {}
+    for name in ("probes", "ef_search", "candidates"):
+        if body.get(name) is not None:
+            options[name] = int(body[name])
+    for name in ("files", "clusters"):
+        if body.get(name):
+            options[name] = list(body[name])
+    options["exact"] = bool(body.get("exact", False))
+    return options
+
+
+def create_app(engine, max_k=100, max_batch=64):
+    def request_k(body):
+        return min(max(int(body.get("k", 10)), 1), max_k)
+
+    async def request_body(request):
+        # Invalid JSON raises ValueError like the other bad request values
+        body = await request.json()
+        if not isinstance(body, dict):
+            raise ValueError("the request body must be a JSON object")
+        return body
+
+    async def search(request):
+        try:
+            body = await request_body(request)
+            if not body.get("query"):
+                return JSONResponse({"error": "query is required"}, status_code=400)
+            start = time.perf_counter()
+            results = await run_in_threadpool(engine.search, body["query"], request_k(body), **search_options(body))
+        except ValueError as e:
+            return JSONResponse({"error": str(e)}, status_code=400)
+        return JSONResponse({"results": results, "ms": round((time.perf_counter() - start) * 1000, 2)})
+
+    async def search_batch(request):
+        try:
+            body = await request_body(request)
+            queries = body.get("queries") or []
+            if not queries or len(queries) > max_batch:
+                return JSONResponse({"error": f"queries must contain 1 - {max_batch} items"}, status_code=400)
+            start = time.perf_counter()
+            results = await run_in_threadpool(engine.search_batch, queries, request_k(body), **search_options(body))
+        except ValueError as e:
+            return JSONResponse({"error": str(e)}, status_code=400)
+        return JSONResponse({"results": results, "ms": round((time.perf_counter() - start) * 1000, 2)})
+
+    async def health(request):
+        cache = engine.cache
+        return JSONResponse({"status": "ok", "table": engine.table_name, "cache_entries": len(cache.entries),
+                             "cache_hits": cache.hits, "cache_misses": cache.misses})
+
+    @asynccontextmanager
+    async def lifespan(app):
+        yield
+        engine.close()
+
+    return Starlette(routes=[
+        Route("/search", search, methods=["POST"]),
+        Route("/search/batch", search_batch, methods=["POST"]),
+        Route("/health", health, methods=["GET"]),
+    ], lifespan=lifespan)
+
+
+if __name__ == "__main__":
+    args = parse_search_args()
+    env_dict = get_env()
+    client = OpenAI(api_key=env_dict['OPENAI_API_KEY'])
+    engine = SearchEngine(env_dict, client, args.embedding_model, args.pool_size, args.cache_entries,
+                          args.probes, args.ef_search)
+    uvicorn.run(create_app(engine), host=args.host, port=args.port)
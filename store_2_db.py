@@ -2,89 +2,308 @@ from openai import OpenAI
 import numpy as np
 import psycopg2
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+import hashlib
+import io
 import re
+import struct
+import time
+from embeddings import backoff, embed_items, request_dimensions, MAX_INPUTS_PER_REQUEST, MODEL_DIMENSIONS
+from embedding_cache import EmbeddingCache, cached_embed_items
+from vector_index import build_index, embedding_column, vector_types, BITS_COLUMN
+from metrics import metrics
 
 def get_embedding2(client, text, model="text-embedding-3-small"):
     normalized_text = normalize_text(text)
     return client.embeddings.create(input=[normalized_text], model=model).data[0].embedding
 
 def normalize_text(text):
-    text = text.lower()
+    # Postgres text cannot hold NUL characters
+    text = text.replace("\x00", "").lower()
     text = re.sub(r"\s+", " ", text)
     return text
 
 
-def store_chunks(model, env_dict,parsed_files):
+COPY_BATCH_ROWS = 1000
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+COPY_TRAILER = struct.pack("!h", -1)
+
+
+def copy_field(value):
+    return struct.pack("!i", len(value)) + value
+
+
+def copy_vector(emb, copy_type=">f4"):
+    # pgvector binary format: int16 dim, int16 unused, big-endian float32 (vector) or float16 (halfvec) values
+    values = np.asarray(emb, dtype=copy_type)
+    return struct.pack("!hh", len(values), 0) + values.tobytes()
+
+
+def copy_rows(conn, table_name, rows, commit=True, copy_type=">f4"):
+    # Binary COPY of (file, page, position, text_chunk, embedding) rows, committed as one transaction
+    buffer = io.BytesIO()
+    buffer.write(COPY_HEADER)
+    for file_name, page, position, text, emb in rows:
+        buffer.write(struct.pack("!h", 5))
+        buffer.write(copy_field(file_name.encode("utf-8")))
+        buffer.write(copy_field(struct.pack("!i", page)))
+        buffer.write(copy_field(struct.pack("!i", position)))
+        buffer.write(copy_field(text.encode("utf-8")))
+        buffer.write(copy_field(copy_vector(emb, copy_type)))
+    buffer.write(COPY_TRAILER)
+    buffer.seek(0)
+    with metrics.stage("db_write", items=len(rows)):
+        with conn.cursor() as cursor:
+            cursor.copy_expert(f"COPY {table_name} (file, page, position, text_chunk, embedding) "
+                               f"FROM STDIN WITH (FORMAT binary)", buffer)
+        if commit:
+            conn.commit()
+
+
+def copy_duplicates(conn, table_name, duplicates, commit=True):
+    # Rows of duplicate chunks get the stored vector of their canonical chunk without leaving the database;
+    # duplicates are ((file, page, position, text), ((canonical file, page, position), md5 of its text)) pairs.
+    # The text digest tells the row of this run from a stale row with the same key left by an earlier run
+    keys, canonical = zip(*duplicates)
+    canonical_keys, digests = zip(*canonical)
+    columns = ([list(column) for column in zip(*keys)] + [list(column) for column in zip(*canonical_keys)] +
+               [[digest.hex() for digest in digests]])
+    with metrics.stage("db_write", items=len(duplicates)):
+        with conn.cursor() as cursor:
+            cursor.execute(f"""
+            INSERT INTO {table_name} (file, page, position, text_chunk, embedding)
+            SELECT DISTINCT ON (d.file, d.page, d.position) d.file, d.page, d.position, d.text_chunk, c.embedding
+            FROM unnest(%s::text[], %s::int[], %s::int[], %s::text[], %s::text[], %s::int[], %s::int[], %s::text[])
+                AS d(file, page, position, text_chunk, c_file, c_page, c_position, c_md5)
+            JOIN {table_name} c ON c.file = d.c_file AND c.page = d.c_page AND c.position = d.c_position
+                AND md5(c.text_chunk) = d.c_md5;
+            """, columns)
+        if commit:
+            conn.commit()
+
+
+def chunk_items(parsed_files):
+    # (key, text, tokens) items for the embedding engine; key maps the vector back to its row
+    for file_chunks in parsed_files:
+        for chunk in parsed_files[file_chunks]:
+            n = parsed_files[file_chunks][chunk]
+            page, position = chunk.split("_")
+            text = normalize_text(n['text'])
+            if len(text.strip()) > 20:
+                yield (file_chunks, int(page), int(position), text), text.strip(), n['length']
+
+
+def store_chunks(model, env_dict, parsed_files, *args, **kwargs):
+    return store_items(model, env_dict, chunk_items(parsed_files), *args, **kwargs)
+
+
+def store_items(model, env_dict, items, concurrency=4, batch_size=MAX_INPUTS_PER_REQUEST,
+                requests_per_minute=0, tokens_per_minute=0, cache_file=None, cache_size_mb=1024,
+                replace_files=None, journal=None, max_retries=6, dedup=None):
+    # Embeds and stores (key, text, tokens) chunk items as they arrive, items may be a lazy stream.
+    # With replace_files the rows of those files are deleted and re-inserted in a single transaction.
+    # With a journal, committed batches are checkpointed, chunks failing for good are recorded there and
+    # the run goes on, and a resumed run skips the chunks the table already holds.
+    # With dedup (a ChunkDeduplicator) duplicate chunks are not embedded
+    cache = EmbeddingCache(cache_file, cache_size_mb) if cache_file else None
     try:
-        client = OpenAI(api_key=env_dict['OPENAI_API_KEY'])
+        # Retries and 429 handling are done by the embedding engine's rate limiter
+        client = OpenAI(api_key=env_dict['OPENAI_API_KEY'], max_retries=0)
         db_host = env_dict['DB_HOST']
         port = env_dict['DB_PORT']
         db_user = env_dict['DB_USER']
         password = env_dict['DB_PASSWORD']
         db_name = env_dict['DB_NAME']
         table_name = env_dict['DB_TABLE_NAME']
+
+        def connect():
+            return psycopg2.connect(dbname=db_name, user=db_user, password=password, host=db_host, port=port)
+
         # Connect to the default postgres database to check/create database
         print(f"Starting to embed to {db_name}, table {table_name}")
-        conn = psycopg2.connect(dbname=db_name, user=db_user, password=password, host=db_host, port=port)
-        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
-        cursor = conn.cursor()
+        conn = connect()
+        # Vector type and size come from the table, so the requested embeddings always fit the column
+        with conn.cursor() as cursor:
+            vector_type, dim, _ = embedding_column(cursor, table_name)
+        dimensions = request_dimensions(model, dim)
+        copy_type = vector_types[vector_type]["copy_type"]
+        # Shortened vectors of the same text are different cache entries
+        cache_model = f"{model}@{dimensions}" if dimensions else model
+        replace = replace_files is not None
+        if replace:
+            with conn.cursor() as cursor:
+                cursor.execute(f"DELETE FROM {table_name} WHERE file = ANY(%s);", (list(replace_files),))
+                print(f"Deleted {cursor.rowcount} rows of {len(replace_files)} changed or removed files")
+        # Only rows of the files the interrupted run had started, and only with the same text - a row of
+        # an older run at the same position of a changed file is embedded again
+        stored_keys = set()
+        if journal and journal.resumed and journal.unfinished():
+            with conn.cursor() as cursor:
+                cursor.execute(f"SELECT file, page, position, md5(text_chunk) FROM {table_name} WHERE file = ANY(%s);",
+                               (list(journal.unfinished()),))
+                stored_keys = set(cursor.fetchall())
+            conn.commit()
+            print(f"Resuming: {len(stored_keys)} chunks of unfinished files are already stored")
         i = 0
-        for file_chunks in parsed_files:
-            for chunk in parsed_files[file_chunks]:
-                n = parsed_files[file_chunks][chunk]
-                page, position = chunk.split("_")
-                text = normalize_text(n['text'])
-                if len(text.strip()) > 20:
-                    emb = get_embedding2(client, text.strip(), model)
-                    embedding_str = np.array(emb).tolist()
-                    cursor.execute(f"""
-                                    INSERT INTO {table_name} (file, page, position, text_chunk, embedding)
-                                    VALUES (%s, %s, %s, %s, %s);
-                                """, (file_chunks, int(page), int(position), text, embedding_str))
-                    i += 1
-                    print(f"\rStored: {i} records", end="", flush=True)
-                    if i % 100 == 0:
-                        conn.commit()
-        cursor.close()
+        rows = []
+        uncommitted = []
+
+        def unstored(items):
+            # Chunks an interrupted run already stored count as written without being embedded again
+            skipped = []
+            for item in items:
+                if (*item[0][:3], hashlib.md5(item[0][3].encode("utf-8")).hexdigest()) in stored_keys:
+                    skipped.append(item[0])
+                    if len(skipped) >= COPY_BATCH_ROWS:
+                        journal.stored(skipped)
+                        skipped = []
+                else:
+                    yield item
+            journal.stored(skipped)
+
+        def failed(batch, error, cached):
+            metrics.increment("failed_chunks", len(batch))
+            for item in batch:
+                journal.failure(item[0][0] if cached else item[0], error)
+
+        def retried(operation, *args):
+            # A failed statement is rolled back as a whole, so a transient error is retried on a new connection
+            nonlocal conn
+            attempt = 0
+            while True:
+                try:
+                    if conn.closed:
+                        conn = connect()
+                    return operation(conn, table_name, *args)
+                except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                    attempt += 1
+                    if replace or attempt > max_retries:
+                        raise
+                    metrics.increment("db_retries")
+                    delay = backoff(attempt)
+                    print(f"\nRetrying the database write in {delay:.1f}s (attempt {attempt}): {e}")
+                    conn.close()
+                    time.sleep(delay)
+
+        def savepoint(statement):
+            with conn.cursor() as cursor:
+                cursor.execute(f"{statement} copy_batch;")
+
+        def write(rows):
+            # Returns the keys of the written rows; rows the table rejects are isolated by halving and fail for good.
+            # In replace mode the batch is a savepoint, so a rejected row does not roll back the whole transaction
+            try:
+                if replace:
+                    savepoint("SAVEPOINT")
+                retried(copy_rows, rows, not replace, copy_type)
+                if replace:
+                    savepoint("RELEASE SAVEPOINT")
+                return [row[:3] for row in rows]
+            except psycopg2.DataError as e:
+                if journal is None:
+                    raise
+                if replace:
+                    savepoint("ROLLBACK TO SAVEPOINT")
+                else:
+                    conn.rollback()
+                if len(rows) == 1:
+                    metrics.increment("failed_chunks")
+                    journal.failure(rows[0], e)
+                    return []
+                return write(rows[:len(rows) // 2]) + write(rows[len(rows) // 2:])
+
+        def flush(rows):
+            # Returns the number of stored rows; skipped duplicates only count as done in the journal
+            keys = write(rows) if rows else []
+            skipped = []
+            if dedup:
+                written = set(keys)
+                duplicates = dedup.ready([row for row in rows if row[:3] in written])
+                if duplicates:
+                    retried(copy_rows, duplicates, not replace, copy_type)
+                    keys += [row[:3] for row in duplicates]
+                late = dedup.take_late()
+                if late:
+                    retried(copy_duplicates, late, not replace)
+                    keys += [key[:3] for key, _ in late]
+                skipped = dedup.take_skipped()
+            if replace:
+                uncommitted.extend(keys + skipped)
+            elif journal:
+                journal.stored(keys + skipped)
+            return len(keys)
+
+        def embed(items, cached=False):
+            return embed_items(client, model, items, concurrency=concurrency, max_inputs=batch_size,
+                               requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute,
+                               dimensions=dimensions, max_retries=max_retries,
+                               on_failure=(lambda batch, error: failed(batch, error, cached)) if journal else None)
+
+        if journal:
+            items = journal.track(items)
+            if stored_keys:
+                items = unstored(items)
+        if dedup:
+            items = dedup.filter(items)
+        if cache:
+            embedded = cached_embed_items(cache, cache_model, items, lambda misses: embed(misses, True))
+        else:
+            embedded = embed(items)
+        for (file_name, page, position, text), emb in embedded:
+            rows.append((file_name, page, position, text, emb))
+            if len(rows) >= COPY_BATCH_ROWS:
+                i += flush(rows)
+                rows = []
+                print(f"\rStored: {i} records", end="", flush=True)
+        if rows or dedup:
+            i += flush(rows)
+            print(f"\rStored: {i} records", end="", flush=True)
+        if dedup:
+            for key in dedup.take_pending():
+                metrics.increment("failed_chunks")
+                if journal:
+                    journal.failure(key, "the canonical chunk of this duplicate failed")
+            dedup.report()
+        with metrics.stage("db_write"):
+            conn.commit()
         conn.close()
+        if journal:
+            journal.stored(uncommitted)
+            journal.complete(i)
+        return i
     except Exception as e:
         print(f"Exception {e}")
+        if journal:
+            print(f"Stored chunks are recorded in {journal.path} - run again with --resume to continue")
+    finally:
+        if cache:
+            print()
+            cache.close()
+            cache.report()
+            metrics.increment("embedding_cache_hits", cache.hits)
+            metrics.increment("embedding_cache_misses", cache.misses)
 
-def create_index(env_dict):
+def create_index(env_dict, index_type="auto", max_memory_mb=4096, workers=4, rebuild=False):
+    # Index type and parameters follow the table size, the new index replaces the old one without blocking reads.
+    # A valid index of the same kind is kept until the table outgrows it or rebuild is set
     try:
-        db_host = env_dict['DB_HOST']
-        port = env_dict['DB_PORT']
-        db_user = env_dict['DB_USER']
-        password = env_dict['DB_PASSWORD']
-        db_name = env_dict['DB_NAME']
-        table_name = env_dict['DB_TABLE_NAME']
-        # Connect to the default postgres database to check/create database
-        print(f"Starting to create index on  {db_name}, table {table_name}")
-        conn = psycopg2.connect(dbname=db_name, user=db_user, password=password, host=db_host, port=port)
-        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
-        cursor = conn.cursor()
-        delete_str = f"DROP INDEX IF EXISTS {db_name}_{table_name}_idx"
-        cursor.execute(delete_str)
-        query_str = f"CREATE INDEX ON {table_name} USING ivfflat (embedding vector_cosine_ops) WITH (lists = 100)"
-        cursor.execute(query_str)
-        cursor.close()
-        conn.close()
-        print(f"Index created: {db_name}_{table_name}_idx")
+        with metrics.stage("index"):
+            return build_index(env_dict, index_type, max_memory_mb, workers, rebuild)
     except Exception as e:
         print(f"Exception {e}")
 
 
 
-def setup_database_and_table(model, env_dict):
+def setup_database_and_table(model, env_dict, dimensions=None, vector_type="vector", binary=False):
+    # dimensions shortens text-embedding-3 vectors, vector_type "halfvec" stores them as float16 and binary
+    # adds a generated bit column (binary quantized embedding) for a Hamming distance pre-filter
     db_host = env_dict['DB_HOST']
     port = env_dict['DB_PORT']
     db_user = env_dict['DB_USER']
     password = env_dict['DB_PASSWORD']
     db_name = env_dict['DB_NAME']
     table_name = env_dict['DB_TABLE_NAME']
-    vector_dimension = 1536
-    if model == 'text-embedding-3-large':
-        vector_dimension = 3072
+    vector_dimension = dimensions or MODEL_DIMENSIONS[model]
+    request_dimensions(model, vector_dimension)
     # Connect to the default postgres database to check/create database
     conn = psycopg2.connect(dbname='postgres', user=db_user, password=password, host=db_host, port=port)
     conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
@@ -117,12 +336,27 @@ def setup_database_and_table(model, env_dict):
         page INTEGER,
         position INTEGER,
         text_chunk TEXT,
-        embedding VECTOR({vector_dimension})
+        embedding {vector_type.upper()}({vector_dimension})
     );
     """)
+    # Lookups by chunk key - duplicate chunks copy the vector of their canonical row, --resume and -n deletes
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS {table_name}_chunk_idx ON {table_name} (file, page, position);")
+    existing_type, existing_dimension, has_bits = embedding_column(cursor, table_name)
+    if (existing_type, existing_dimension) != (vector_type, vector_dimension):
+        conn.rollback()
+        cursor.close()
+        conn.close()
+        raise ValueError(f"Table {table_name} stores {existing_type}({existing_dimension}), "
+                         f"not {vector_type}({vector_dimension}) - use another table or the same storage options")
+    if binary and not has_bits:
+        cursor.execute(f"""
+        ALTER TABLE {table_name} ADD COLUMN {BITS_COLUMN} BIT({vector_dimension})
+            GENERATED ALWAYS AS (binary_quantize(embedding)::bit({vector_dimension})) STORED;
+        """)
 
     conn.commit()
     cursor.close()
     conn.close()
 
-    print(f'Table {table_name} is ready in database {db_name}.')
\ No newline at end of file
+    print(f'Table {table_name} ({vector_type}({vector_dimension}){", binary" if binary or has_bits else ""}) '
+          f'is ready in database {db_name}.')
\ No newline at end of file
@@ -0,0 +1,173 @@
+import json
+import time
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+# Storage types of the embedding column: binary COPY value type, bytes per dimension, cosine operator
+# class and the largest dimension pgvector can index
+vector_types = {
+    "vector": {"copy_type": ">f4", "bytes": 4, "ops": "vector_cosine_ops", "max_index_dimensions": 2000},
+    "halfvec": {"copy_type": ">f2", "bytes": 2, "ops": "halfvec_cosine_ops", "max_index_dimensions": 4000},
+}
+# Optional binary quantized copy of the embedding for a Hamming distance pre-filter
+BITS_COLUMN = "embedding_bits"
+MAX_BITS_INDEX_DIMENSIONS = 64000
+# Below this many rows an exact scan is fast enough and an approximate index only costs recall
+MIN_INDEX_ROWS = 10000
+# Above this many rows HNSW build time and memory get impractical, IVFFlat builds much faster
+MAX_HNSW_ROWS = 5000000
+# Both index types take in new rows as they are inserted; a valid index is only rebuilt once the table
+# has grown by this factor since its build (IVFFlat lists are then too few, HNSW m may be too small)
+REBUILD_GROWTH = 2.0
+
+
+def embedding_column(cursor, table_name):
+    # (vector type, dimension, has binary column) read from the table definition - the table created by
+    # setup_database_and_table is the one place where the storage choice is made
+    cursor.execute("""
+        SELECT a.attname, t.typname, a.atttypmod FROM pg_attribute a JOIN pg_type t ON t.oid = a.atttypid
+        WHERE a.attrelid = %s::regclass AND a.attname IN ('embedding', %s) AND NOT a.attisdropped;
+    """, (table_name, BITS_COLUMN))
+    columns = {name: (type_name, typmod) for name, type_name, typmod in cursor.fetchall()}
+    vector_type, dim = columns["embedding"]
+    return vector_type, dim if dim > 0 else None, BITS_COLUMN in columns
+
+
+def index_params(rows, dim, index_type="auto"):
+    # Index type and build parameters scaled with the table size and the vector dimension
+    if index_type == "auto":
+        index_type = "hnsw" if rows <= MAX_HNSW_ROWS else "ivfflat"
+    if index_type == "hnsw":
+        m = 16 if rows < 1000000 and dim <= 1024 else 24
+        return index_type, {"m": m, "ef_construction": 4 * m}
+    # pgvector recommendation: rows / 1000 lists up to 1M rows, sqrt(rows) above
+    lists = max(rows // 1000, 10) if rows <= 1000000 else int(rows ** 0.5)
+    return index_type, {"lists": lists}
+
+
+def estimated_index_mb(rows, vector_bytes, index_type, params):
+    # Vectors plus graph links (HNSW) or list overhead (IVFFlat), used to size maintenance_work_mem
+    per_row = vector_bytes + 8
+    if index_type == "hnsw":
+        per_row += params["m"] * 2 * 8
+    return rows * per_row * 1.2 / 1024 / 1024
+
+
+def column_indexes(cursor, table_name, column):
+    cursor.execute("""
+        SELECT indexname FROM pg_indexes
+        WHERE tablename = %s AND (indexdef ILIKE '%%USING ivfflat%%' OR indexdef ILIKE '%%USING hnsw%%')
+        AND indexdef ILIKE %s;
+    """, (table_name, f"%({column} %"))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def existing_index(cursor, index_name):
+    # (index type, params, rows at build time) of a valid index, or None; the rows are kept in the index comment
+    cursor.execute("""
+        SELECT am.amname, c.reloptions, i.indisvalid, obj_description(c.oid, 'pg_class')
+        FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid JOIN pg_am am ON am.oid = c.relam
+        WHERE c.oid = to_regclass(%s);
+    """, (index_name,))
+    row = cursor.fetchone()
+    if row is None or not row[2]:
+        return None
+    index_type, options, _, comment = row
+    params = {key: int(value) for key, value in (option.split("=", 1) for option in options or [])}
+    try:
+        rows = json.loads(comment)["rows"] if comment else None
+    except (ValueError, KeyError, TypeError):
+        rows = None
+    return index_type, params, rows
+
+
+def index_is_current(cursor, index_name, index_type, params, rows):
+    # Keeps an index of the same type and - for HNSW, whose parameters do not follow the row count
+    # continuously - the same parameters, unless the table outgrew it
+    existing = existing_index(cursor, index_name)
+    if existing is None:
+        return False
+    existing_type, existing_params, built_rows = existing
+    if existing_type != index_type or (index_type == "hnsw" and existing_params != params):
+        return False
+    return built_rows is not None and rows <= built_rows * REBUILD_GROWTH
+
+
+def replace_index(cursor, table_name, column, ops, index_name, index_type, params, rows=0, rebuild=False):
+    # The new index is built next to the old one; readers keep using the old index until it is swapped in.
+    # Indexes stacked up by earlier runs on the same column go as well. A current index is kept unless
+    # rebuild is set.
+    with_params = ", ".join(f"{key} = {value}" for key, value in params.items())
+    if not rebuild and index_is_current(cursor, index_name, index_type, params, rows):
+        print(f"Index {index_name} ({index_type}) is kept, it is maintained as rows are inserted")
+        return {"index": index_name, "type": index_type, "kept": True}
+    new_index_name = f"{index_name}_new"
+    # A failed concurrent build leaves an invalid index behind
+    cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {new_index_name};")
+    start = time.perf_counter()
+    cursor.execute(f"CREATE INDEX CONCURRENTLY {new_index_name} ON {table_name} "
+                   f"USING {index_type} ({column} {ops}) WITH ({with_params});")
+    build_seconds = time.perf_counter() - start
+    for old_index in column_indexes(cursor, table_name, column):
+        if old_index != new_index_name:
+            cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {old_index};")
+            print(f"Dropped index {old_index}")
+    cursor.execute(f"ALTER INDEX {new_index_name} RENAME TO {index_name};")
+    cursor.execute(f"COMMENT ON INDEX {index_name} IS %s;", (json.dumps({"rows": rows}),))
+    cursor.execute("SELECT pg_relation_size(%s::regclass), pg_size_pretty(pg_relation_size(%s::regclass));",
+                   (index_name, index_name))
+    size_bytes, size_pretty = cursor.fetchone()
+    print(f"Index created: {index_name} ({index_type}, {with_params}) in {build_seconds:.1f}s, size {size_pretty}")
+    return {"index": index_name, "type": index_type, "params": params,
+            "build_seconds": round(build_seconds, 3), "size_bytes": size_bytes}
+
+
+def build_index(env_dict, index_type="auto", max_memory_mb=4096, workers=4, rebuild=False):
+    db_host = env_dict['DB_HOST']
+    port = env_dict['DB_PORT']
+    db_user = env_dict['DB_USER']
+    password = env_dict['DB_PASSWORD']
+    db_name = env_dict['DB_NAME']
+    table_name = env_dict['DB_TABLE_NAME']
+    print(f"Starting to create index on {db_name}, table {table_name}")
+    conn = psycopg2.connect(dbname=db_name, user=db_user, password=password, host=db_host, port=port)
+    # CREATE / DROP INDEX CONCURRENTLY cannot run inside a transaction
+    conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+    cursor = conn.cursor()
+    cursor.execute(f"ANALYZE {table_name};")
+    cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass;", (table_name,))
+    rows = max(cursor.fetchone()[0], 0)
+    vector_type, dim, has_bits = embedding_column(cursor, table_name)
+    if dim is None:
+        cursor.execute(f"SELECT vector_dims(embedding) FROM {table_name} WHERE embedding IS NOT NULL LIMIT 1;")
+        row = cursor.fetchone()
+        dim = row[0] if row else 0
+    storage = vector_types[vector_type]
+    if index_type == "none" or (index_type == "auto" and rows < MIN_INDEX_ROWS):
+        print(f"No vector index built for {rows} rows, exact search is used")
+        cursor.close()
+        conn.close()
+        return None
+
+    index_type, params = index_params(rows, dim, index_type)
+    memory_mb = int(min(max(estimated_index_mb(rows, storage["bytes"] * dim, index_type, params), 64), max_memory_mb))
+    cursor.execute(f"SET maintenance_work_mem = '{memory_mb}MB';")
+    cursor.execute(f"SET max_parallel_maintenance_workers = {int(workers)};")
+    print(f"Vector index {index_type} for {rows} rows x {dim} dimensions ({vector_type}), "
+          f"maintenance_work_mem {memory_mb}MB, {workers} parallel workers")
+
+    built = {"rows": rows, "dimensions": dim, "vector_type": vector_type}
+    if dim > storage["max_index_dimensions"]:
+        print(f"{vector_type} with {dim} dimensions cannot be indexed by pgvector "
+              f"(max {storage['max_index_dimensions']}) - use halfvec storage or shortened embeddings")
+    else:
+        built["embedding"] = replace_index(cursor, table_name, "embedding", storage["ops"],
+                                           f"{table_name}_embedding_idx", index_type, params, rows, rebuild)
+    if has_bits and dim <= MAX_BITS_INDEX_DIMENSIONS:
+        # Hamming distance on the binary column, used as a coarse pre-filter before re-ranking
+        built["bits"] = replace_index(cursor, table_name, BITS_COLUMN, "bit_hamming_ops",
+                                      f"{table_name}_{BITS_COLUMN}_idx", index_type, params, rows, rebuild)
+    cursor.close()
+    conn.close()
+    return built